@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import csv
+import gzip
+from datetime import datetime, timedelta, timezone
+import importlib.util
+import itertools
+import json
+import os
+from pathlib import Path
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+
+# Paths; --site moves them
+site_dir = Path("/home/kav/kaiwebsite")
+bench_dir = site_dir / ".build-cache/bench"
+history_path = bench_dir / "history.json"
+
+
+def set_site(site):
+    global site_dir, bench_dir, history_path
+    site_dir = Path(site)
+    bench_dir = site_dir / ".build-cache/bench"
+    history_path = bench_dir / "history.json"
+
+
+# Bump when the synthetic archive changes, so cached archives are rebuilt
+ARCHIVE_VERSION = 2
+
+# Build phases and, between plan and index, the render stages summed over
+# every post, all as generate-posts-v2.py --profile records them. 'scan'
+# covers reading posts.csv and hashing each export to detect edits; 'sort'
+# is ordering the posts and 'plan' working out their navigation links and
+# which pages to render; 'search' is collecting each post's words and
+# 'index' building writing.html and search/.
+PHASES = ('scan', 'sort', 'plan', 'read', 'cleanup', 'parse', 'search', 'fill', 'write', 'index', 'feeds')
+
+# Queries timed against the search index: common words, rare ones, a phrase
+SEARCH_QUERIES = ('the', 'water', 'quiet river', '"the ocean"', 'snow desert light', 'kalomi')
+
+WORDS = """the a of and to in that it was for on with as i my at this but be
+from by or had not they we were so you one all there what when about out up
+into time just then more like could back water light summer city winter
+ocean book night morning memory body field small years first last still
+long through over again house snow tide desert river quiet bright cold""".split()
+
+
+def vocabulary(size=5000):
+    # Real words first, then made-up ones, weighted by Zipf's law so the
+    # search index sees a few very common terms and a long tail of rare ones
+    rng = random.Random(0)
+    syllables = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ze', 'ha', 'po', 'li', 'an', 'or', 'es']
+    words = list(WORDS)
+    seen = set(words)
+    while len(words) < size:
+        word = ''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words, list(itertools.accumulate(1 / rank ** 1.07 for rank in range(1, size + 1)))
+
+
+VOCABULARY, VOCABULARY_WEIGHTS = vocabulary()
+
+
+def load_generator():
+    # The generator is a script with a dash in its name, so load it by path
+    spec = importlib.util.spec_from_file_location(
+        'generate_posts_v2', Path(__file__).with_name('generate-posts-v2.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def sentence(rng, n):
+    return ' '.join(rng.choices(VOCABULARY, cum_weights=VOCABULARY_WEIGHTS, k=n)).capitalize() + '.'
+
+
+def paragraph(rng):
+    return '<p>' + ' '.join(sentence(rng, rng.randint(6, 20)) for _ in range(rng.randint(2, 6))) + '</p>'
+
+
+def preformatted_block(rng):
+    lines = '\n'.join(' ' * rng.choice((0, 0, 2, 6)) + sentence(rng, rng.randint(3, 8))
+                      for _ in range(rng.randint(4, 16)))
+    return ('<div class="preformatted-block" data-component-name="PreformattedTextBlockToDOM">'
+            '<label class="hide-text" contenteditable="false">Text within this block will maintain '
+            'its original spacing when published</label>'
+            f'<pre class="text">{lines}</pre></div>')
+
+
+def subscription_widget(rng):
+    return ('<div class="subscription-widget-wrap-editor" data-attrs="{&quot;url&quot;:'
+            '&quot;https://goldenblue.substack.com/subscribe?&quot;}" '
+            'data-component-name="SubscribeWidgetToDOM"><div class="subscription-widget show-subscribe">'
+            '<div class="preamble"><p class="cta-caption">Thanks for reading golden blue! Subscribe for '
+            'free to receive new posts and support my work.</p></div><form class="subscription-widget-subscribe">'
+            '<input type="email" class="email-input" name="email" placeholder="Type your email…" tabindex="-1">'
+            '<input type="submit" class="button primary" value="Subscribe"><div class="fake-input-wrapper">'
+            '<div class="fake-input"></div><div class="fake-button"></div></div></form></div></div>'
+            '<p class="button-wrapper" data-attrs="{}"><a class="button primary" '
+            'href="https://goldenblue.substack.com/subscribe?"><span>Subscribe now</span></a></p>')
+
+
+def spotify_embed(rng):
+    track = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in range(22))
+    return (f'<iframe class="spotify-wrap" data-attrs="{{&quot;image&quot;:&quot;&quot;}}" '
+            f'src="https://open.spotify.com/embed/track/{track}" frameborder="0" gesture="media" '
+            'allowfullscreen="true" allow="encrypted-media" data-component-name="Spotify2ToDOM"></iframe>')
+
+
+def image_block(rng):
+    name = f"{rng.getrandbits(128):032x}_{rng.choice((1456, 2048, 4096))}x{rng.choice((1092, 1536, 3072))}.jpeg"
+    url = f"https://substack-post-media.s3.amazonaws.com/public/images/{name}"
+    cdn = f"https://substackcdn.com/image/fetch/$s_!abcd!,w_{{w}},c_limit,f_auto,q_auto:good/{url.replace(':', '%3A').replace('/', '%2F')}"
+    srcset = ', '.join(cdn.format(w=w) + f' {w}w' for w in (424, 848, 1272, 1456))
+    return ('<div class="captioned-image-container"><figure><a class="image-link image2 is-viewable-img" '
+            f'target="_blank" href="{cdn.format(w=1456)}" data-component-name="Image2ToDOM">'
+            f'<div class="image2-inset"><picture><source type="image/webp" srcset="{srcset}" sizes="100vw">'
+            f'<img src="{url}" width="1456" height="1092" class="sizing-normal" alt="" srcset="{srcset}" '
+            'sizes="100vw" loading="lazy"></picture><div class="image-link-expand">'
+            '<div class="pencraft pc-display-flex pc-gap-8 pc-reset">'
+            '<button tabindex="0" type="button" class="pencraft pc-reset icon-container restack-image">'
+            '<svg width="20" height="20"><g><title></title><path d="M2.5 7.8"></path></g></svg></button>'
+            '<button tabindex="0" type="button" class="pencraft pc-reset icon-container view-image">'
+            '<svg width="20" height="20"><polyline points="15 3 21 3 21 9"></polyline></svg></button>'
+            '</div></div></div></a></figure></div>')
+
+
+def inline_image(rng, size):
+    data = ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/')
+                   for _ in range(64))
+    return f'<p><img src="data:image/jpeg;base64,{data * (size // 64)}" alt=""></p>'
+
+
+def synthetic_post(rng):
+    blocks = []
+    for _ in range(rng.randint(4, 40)):
+        roll = rng.random()
+        if roll < 0.70:
+            blocks.append(paragraph(rng))
+        elif roll < 0.78:
+            blocks.append(preformatted_block(rng))
+        elif roll < 0.84:
+            blocks.append(image_block(rng))
+        elif roll < 0.88:
+            blocks.append(spotify_embed(rng))
+        elif roll < 0.99:
+            blocks.append(f'<h4>{sentence(rng, 3)}</h4>')
+        else:
+            blocks.append(inline_image(rng, rng.randint(50_000, 500_000)))
+    blocks.insert(rng.randint(0, len(blocks)), subscription_widget(rng))
+    return '\n'.join(blocks)
+
+
+def make_archive(archive_dir, count, seed):
+    """Write a Substack-style export of `count` synthetic posts.
+
+    Archives are cached by size, seed and ARCHIVE_VERSION, since writing a
+    large one takes longer than building it.
+    """
+    marker = archive_dir / "complete.json"
+    stamp = {'version': ARCHIVE_VERSION, 'count': count, 'seed': seed}
+    if marker.exists() and json.loads(marker.read_text()) == stamp:
+        return
+    if archive_dir.exists():
+        shutil.rmtree(archive_dir)
+    posts_dir = archive_dir / "posts"
+    posts_dir.mkdir(parents=True)
+
+    rng = random.Random(seed)
+    start = datetime(2021, 1, 1, tzinfo=timezone.utc)
+    with open(archive_dir / "posts.csv", 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['post_id', 'post_date', 'is_published', 'email_sent_at', 'inbox_sent_at',
+                         'type', 'audience', 'title', 'subtitle', 'podcast_url'])
+        for i in range(count):
+            title = sentence(rng, rng.randint(2, 6))[:-1]
+            post_id = f"{100000000 + i}.post-{i}"
+            published = rng.random() < 0.95
+            date = start + timedelta(minutes=rng.randint(0, 60 * 24 * 365 * 5))
+            writer.writerow([post_id, date.strftime('%Y-%m-%dT%H:%M:%S.000Z'), 'true' if published else 'false',
+                             '', '', 'newsletter', 'everyone', title, '', ''])
+            (posts_dir / f"{post_id}.html").write_text(synthetic_post(rng))
+    marker.write_text(json.dumps(stamp))
+
+
+def bench_site(count):
+    """A throwaway copy of the site to build the archive into.
+
+    Only what a build reads is copied: the templates, and the hand-written
+    pages and scripts it splices the index into and fingerprints. There is
+    no build.json, so every size builds with the default settings.
+    """
+    scratch = bench_dir / f"site-{count}"
+    if scratch.exists():
+        shutil.rmtree(scratch)
+    shutil.copytree(site_dir / "templates", scratch / "templates")
+    for path in itertools.chain(site_dir.glob('*.html'), site_dir.glob('*.js')):
+        shutil.copy2(path, scratch / path.name)
+    return scratch
+
+
+def run_benchmark(count, seed, site):
+    """Build one synthetic archive with the generator and time it.
+
+    This is a real build, through the generator's own main() with --force
+    and --profile, so the phases and render stages are the ones in its
+    --profile trace. Runs in a fresh process per archive size, and renders
+    in that process too, so the peak RSS it reports belongs to that size
+    alone.
+    """
+    set_site(site)
+    gen = load_generator()
+    archive_dir = bench_dir / f"archive-{count}"
+    make_archive(archive_dir, count, seed)
+
+    scratch = bench_site(count)
+    trace_path = scratch / ".build-cache/profile.json"
+    argv = ['--site', str(scratch), '--csv', str(archive_dir / "posts.csv"),
+            '--sources', str(archive_dir / "posts"),
+            '--force', '--search', '--jobs', '1', '--profile', str(trace_path)]
+    # A line per page would bury the results
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        gen.main(argv)
+
+    trace = json.loads(trace_path.read_text())
+    stages = trace['stages']
+    timings = {**{name: stage['seconds'] for name, stage in stages.items()}, **trace['phases']}
+    total = trace['phases']['total']
+    posts = trace['posts_rendered']
+    search = search_stats(gen.search_dir)
+    shutil.rmtree(scratch)
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak_rss *= 1024
+
+    return {
+        'posts': posts,
+        'seconds': total,
+        'posts_per_second': posts / total if total else 0.0,
+        'peak_rss': peak_rss,
+        'bytes_in': stages['read']['bytes_in'],
+        'bytes_out': stages['write']['bytes_out'],
+        'phases': {phase: timings.get(phase, 0.0) for phase in PHASES},
+        'search': search,
+    }
+
+
+def search_stats(search_dir):
+    """Size of the search index, and how long search.js takes to query it.
+
+    Queries run in node, reading the index from disk, so the times are for
+    decoding and matching without the network. Each query is timed cold
+    (its shards not loaded yet) and then warm.
+    """
+    files = sorted(search_dir.iterdir())
+    sizes = [path.stat().st_size for path in files]
+    stats = {
+        'files': len(files),
+        'bytes': sum(sizes),
+        'gzip_bytes': sum(len(gzip.compress(path.read_bytes(), compresslevel=9)) for path in files),
+        'largest_shard': max((size for path, size in zip(files, sizes) if path.name.startswith('terms-')),
+                             default=0),
+        'index_json': (search_dir / "index.json").stat().st_size,
+        'queries': None,
+    }
+    if shutil.which('node') is None:
+        return stats
+
+    script = """
+const fs = require('fs');
+require(process.argv[1]);
+const dir = process.argv[2];
+const queries = JSON.parse(process.argv[3]);
+const search = postSearch.createSearch(async name => JSON.parse(fs.readFileSync(dir + '/' + name)));
+(async () => {
+  const times = {};
+  for (const query of queries) {
+    let started = process.hrtime.bigint();
+    const results = await search.query(query);
+    const cold = Number(process.hrtime.bigint() - started) / 1e6;
+    started = process.hrtime.bigint();
+    await search.query(query);
+    const warm = Number(process.hrtime.bigint() - started) / 1e6;
+    times[query] = {cold_ms: cold, warm_ms: warm, results: results.length};
+  }
+  console.log(JSON.stringify(times));
+})();
+"""
+    result = subprocess.run(
+        ['node', '-e', script, str(Path(__file__).with_name('search.js')), str(search_dir),
+         json.dumps(SEARCH_QUERIES)],
+        capture_output=True, text=True)
+    if result.returncode == 0:
+        stats['queries'] = json.loads(result.stdout)
+    return stats
+
+
+def report(results, previous):
+    header = f"{'posts':>7} {'total s':>9} {'posts/s':>9} {'peak MB':>8}  " + ' '.join(f"{p:>8}" for p in PHASES)
+    print(header)
+    for size, result in results.items():
+        line = (f"{result['posts']:>7} {result['seconds']:>9.3f} {result['posts_per_second']:>9.0f} "
+                f"{result['peak_rss'] / 2**20:>8.1f}  "
+                + ' '.join(f"{result['phases'][p]:>8.3f}" for p in PHASES))
+        old = previous.get(size) if previous else None
+        if old:
+            change = (result['seconds'] - old['seconds']) / old['seconds'] * 100
+            line += f"  ({change:+.1f}% vs previous run)"
+        print(line)
+
+    for size, result in results.items():
+        search = result['search']
+        print(f"Search index for {result['posts']} posts: {search['files']} files, "
+              f"{search['bytes'] / 2**20:.2f} MiB ({search['gzip_bytes'] / 2**20:.2f} MiB gzipped), "
+              f"largest shard {search['largest_shard'] / 2**10:.0f} KiB, "
+              f"index.json {search['index_json'] / 2**10:.0f} KiB")
+        for query, times in (search['queries'] or {}).items():
+            print(f"  {query:<20} {times['results']:>6} results {times['cold_ms']:>9.2f} ms cold "
+                  f"{times['warm_ms']:>8.2f} ms warm")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark generate-posts-v2.py on synthetic archives.")
+    parser.add_argument('--site', type=Path, default=site_dir, metavar='DIR',
+                        help="site whose templates to use; archives and history go in its "
+                             ".build-cache/bench (default: %(default)s)")
+    parser.add_argument('--sizes', default='10,1000,50000',
+                        help="comma-separated archive sizes in posts (default: %(default)s)")
+    parser.add_argument('--seed', type=int, default=1,
+                        help="seed for the synthetic archives (default: %(default)s)")
+    parser.add_argument('--label', default='',
+                        help="note to store with this run in the history")
+    args = parser.parse_args(argv)
+    set_site(args.site)
+
+    history = json.loads(history_path.read_text()) if history_path.exists() else []
+    previous = history[-1]['results'] if history else None
+
+    results = {}
+    for size in (int(s) for s in args.sizes.split(',')):
+        print(f"Benchmarking {size} posts...")
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results[str(size)] = executor.submit(run_benchmark, size, args.seed, site_dir).result()
+
+    report(results, previous)
+
+    # Keep every run so regressions can be traced back
+    history.append({
+        'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'label': args.label,
+        'python': platform.python_version(),
+        'results': results,
+    })
+    bench_dir.mkdir(parents=True, exist_ok=True)
+    history_path.write_text(json.dumps(history, indent=1) + '\n')
+    print(f"Saved: {history_path}")
+
+
+if __name__ == '__main__':
+    main()
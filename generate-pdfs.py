@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import os
+from pathlib import Path
+import re
+import shutil
+import subprocess
+import tempfile
+import zlib
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Paths
+DEFAULT_SITE = Path("/home/kav/kaiwebsite")
+
+
+def set_paths(site=DEFAULT_SITE):
+    # Every path follows the site
+    global site_dir, previews_dir, sized_dir, manifest_path, cache_path
+    site_dir = Path(site)
+    previews_dir = site_dir / "pdf-previews"
+    sized_dir = previews_dir / "sized"
+    manifest_path = previews_dir / "manifest.json"
+    cache_path = site_dir / ".build-cache/pdfs.json"
+
+
+set_paths()
+
+# Settings can also come from the site's build.json, which it shares with
+# generate-posts-v2.py; this reads the ones it has options for
+CONFIG_NAME = 'build.json'
+
+# Previews are small: a first page shown next to the link to the full PDF
+PREVIEW_WIDTHS = (240, 480)
+PREVIEW_SIZES = '240px'
+JPEG_SETTINGS = {'quality': 80, 'progressive': True, 'optimize': True}
+
+# Renderers for the first page, tried in order; both work offline
+RENDERERS = ('pdftoppm', 'mutool')
+
+PDF_OBJECT = re.compile(rb'(\d+)\s+\d+\s+obj\b(.*?)\bendobj', re.DOTALL)
+PDF_STREAM = re.compile(rb'stream\r?\n')
+PDF_TRAILER = re.compile(rb'trailer\s*(<<.*?>>)\s*startxref', re.DOTALL)
+PDF_REF = rb'\s+(\d+)\s+\d+\s+R'
+# Text operators in a page's content: a font and size, or a string shown
+PDF_TEXT = re.compile(rb'/[^\s/\[\]()<>]+\s+([\d.]+)\s+Tf'
+                      rb'|\[((?:\((?:\\.|[^\\)])*\)|<[0-9A-Fa-f\s]*>|[^\]])*)\]\s*TJ'
+                      rb'|(\((?:\\.|[^\\)])*\))\s*Tj', re.DOTALL)
+PDF_TEXT_ITEM = re.compile(rb'\((?:\\.|[^\\)])*\)|<[0-9A-Fa-f\s]*>|-?[\d.]+')
+# A TJ adjustment at least this far left (in thousandths of the font size)
+# is a space between words rather than kerning
+PDF_WORD_SPACE = -200
+# The title is the biggest text among the first few strings on page one
+PDF_TITLE_WINDOW = 20
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stream_data(body):
+    # The decoded stream of an object, if it has one this can decode
+    m = PDF_STREAM.search(body)
+    if m is None:
+        return None
+    data = body[m.end():body.rfind(b'endstream')]
+    if b'/Filter' not in body[:m.start()]:
+        return data
+    if not re.search(rb'/Filter\s*\[?\s*/FlateDecode\s*\]?', body[:m.start()]):
+        return None
+    try:
+        return zlib.decompressobj().decompress(data)
+    except zlib.error:
+        return None
+
+
+def read_objects(data):
+    """Every object in a PDF, by number, including those in object streams.
+
+    Objects are found by scanning rather than through the cross-reference
+    table, so later copies (from incremental updates) replace earlier ones.
+    """
+    objects = {}
+    for m in PDF_OBJECT.finditer(data):
+        number, body = int(m.group(1)), m.group(2)
+        objects[number] = body
+        if b'/ObjStm' not in body[:body.find(b'stream')]:
+            continue
+        # An object stream starts with pairs of object numbers and offsets
+        decoded = stream_data(body)
+        first = re.search(rb'/First\s+(\d+)', body)
+        if decoded is None or first is None:
+            continue
+        first = int(first.group(1))
+        header = [int(n) for n in decoded[:first].split()]
+        offsets = list(zip(header[::2], header[1::2]))
+        for i, (inner, offset) in enumerate(offsets):
+            end = offsets[i + 1][1] if i + 1 < len(offsets) else len(decoded) - first
+            objects.setdefault(inner, decoded[first + offset:first + end])
+    return objects
+
+
+def trailer_ref(data, objects, key):
+    # The last /Root or /Info in a trailer or cross-reference stream wins
+    found = None
+    trailers = [m.group(1) for m in PDF_TRAILER.finditer(data)]
+    trailers += [body for body in objects.values() if b'/XRef' in body[:body.find(b'stream')]]
+    for trailer in trailers:
+        m = re.search(rb'/' + key + PDF_REF, trailer)
+        if m:
+            found = int(m.group(1))
+    return found
+
+
+def pdf_string(data, at):
+    # Decode the literal or hex string starting at data[at]
+    if data[at:at + 1] == b'<':
+        end = data.index(b'>', at)
+        raw = bytes.fromhex(re.sub(rb'\s', b'', data[at + 1:end]).decode('ascii').ljust(2, '0'))
+    else:
+        escapes = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f'}
+        raw = bytearray()
+        depth = 0
+        i = at
+        while i < len(data):
+            ch = data[i:i + 1]
+            if ch == b'\\':
+                nxt = data[i + 1:i + 2]
+                octal = re.match(rb'[0-7]{1,3}', data[i + 1:i + 4])
+                if octal:
+                    raw.append(int(octal.group(), 8) & 0xff)
+                    i += 1 + len(octal.group())
+                    continue
+                if nxt not in (b'\r', b'\n'):
+                    raw += escapes.get(nxt, nxt)
+                i += 2
+                continue
+            if ch == b'(':
+                depth += 1
+                if depth == 1:
+                    i += 1
+                    continue
+            elif ch == b')':
+                depth -= 1
+                if depth == 0:
+                    break
+            raw += ch
+            i += 1
+        raw = bytes(raw)
+    if raw.startswith(b'\xfe\xff'):
+        return raw[2:].decode('utf-16-be', errors='replace')
+    # PDFDocEncoding matches Latin-1 for anything a title is likely to hold
+    return raw.decode('latin-1')
+
+
+def pdf_title(data, objects):
+    # The document title from the Info dictionary, or else its XMP metadata,
+    # or else the first page
+    info = objects.get(trailer_ref(data, objects, b'Info'))
+    if info is not None:
+        m = re.search(rb'/Title\s*(?:([(<])|(\d+)\s+\d+\s+R)', info)
+        if m and m.group(1):
+            title = pdf_string(info, m.start(1)).strip()
+        elif m:
+            target = objects.get(int(m.group(2)), b'').strip()
+            title = pdf_string(target, 0).strip() if target[:1] in (b'(', b'<') else ''
+        else:
+            title = ''
+        if title:
+            return title
+
+    for body in objects.values():
+        if b'/Metadata' not in body[:body.find(b'stream')] or b'/XML' not in body:
+            continue
+        xml = stream_data(body)
+        m = xml and re.search(rb'<dc:title>.*?<rdf:li[^>]*>(.*?)</rdf:li>', xml, re.DOTALL)
+        if m and m.group(1).strip():
+            return m.group(1).strip().decode('utf-8', errors='replace')
+    return first_page_title(objects, objects.get(trailer_ref(data, objects, b'Root'), b''))
+
+
+def shown_text(operand, array):
+    # The text of a Tj string or TJ array; None for hex strings, which are
+    # glyph ids in fonts this can't map back to text
+    if not array:
+        return pdf_string(operand, 0)
+    text = ''
+    for item in PDF_TEXT_ITEM.findall(operand):
+        if item.startswith(b'<'):
+            return None
+        if item.startswith(b'('):
+            text += pdf_string(item, 0)
+        elif float(item) <= PDF_WORD_SPACE:
+            text += ' '
+    return text
+
+
+def first_page_title(objects, catalog):
+    """Guess a title from the biggest text at the top of the first page.
+
+    Papers typeset with TeX rarely fill in the Info title, but their title
+    is the largest text on page one, in fonts whose strings read as text.
+    """
+    node = re.search(rb'/Pages' + PDF_REF, catalog)
+    node = int(node.group(1)) if node else None
+    for _ in range(64):
+        kids = re.search(rb'/Kids\s*\[\s*(\d+)\s+\d+\s+R', objects.get(node, b''))
+        if kids is None:
+            break
+        node = int(kids.group(1))
+    contents = re.search(rb'/Contents\s*\[?\s*(\d+)\s+\d+\s+R', objects.get(node, b''))
+    stream = stream_data(objects.get(int(contents.group(1)), b'')) if contents else None
+    if not stream:
+        return None
+
+    shown = []
+    size = 0.0
+    for m in PDF_TEXT.finditer(stream):
+        if m.group(1):
+            size = float(m.group(1))
+            continue
+        text = shown_text(m.group(2) or m.group(3), m.group(2) is not None)
+        shown.append((size, text))
+        if len(shown) == PDF_TITLE_WINDOW:
+            break
+    if not shown:
+        return None
+    largest = max(size for size, _ in shown)
+    start = next(i for i, (size, _) in enumerate(shown) if size == largest)
+    parts = []
+    for size, text in shown[start:]:
+        if size != largest or text is None:
+            break
+        parts.append(text)
+    title = ' '.join(''.join(ch for ch in ' '.join(parts) if ch >= ' ').split())
+    return title if len(title) > 2 else None
+
+
+def pdf_pages(data, objects):
+    # /Count of the page tree the catalog points to
+    catalog = objects.get(trailer_ref(data, objects, b'Root'), b'')
+    pages = re.search(rb'/Pages' + PDF_REF, catalog)
+    if pages:
+        count = re.search(rb'/Count\s+(\d+)', objects.get(int(pages.group(1)), b''))
+        if count:
+            return int(count.group(1))
+    return None
+
+
+def read_pdf(path):
+    data = path.read_bytes()
+    objects = read_objects(data)
+    return {'title': pdf_title(data, objects), 'pages': pdf_pages(data, objects)}
+
+
+def find_renderer():
+    for name in RENDERERS:
+        command = shutil.which(name)
+        if command:
+            return name, command
+    return None
+
+
+def render_first_page(renderer, source, width, out_dir):
+    # Render page 1 of `source` to a PNG `width` pixels wide; returns its path
+    name, command = renderer
+    out_path = Path(out_dir) / "page.png"
+    if name == 'pdftoppm':
+        args = [command, '-f', '1', '-l', '1', '-singlefile', '-png',
+                '-scale-to-x', str(width), '-scale-to-y', '-1', str(source), str(out_path.with_suffix(''))]
+    else:
+        args = [command, 'draw', '-q', '-o', str(out_path), '-w', str(width), str(source), '1']
+    subprocess.run(args, check=True, capture_output=True)
+    return out_path
+
+
+def make_previews(renderer, source, key):
+    """Write the resized previews of one PDF's first page."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with Image.open(render_first_page(renderer, source, PREVIEW_WIDTHS[-1], tmp_dir)) as page:
+            page = page.convert('RGB')
+            width, height = page.size
+            variants = []
+            for w in (w for w in PREVIEW_WIDTHS if w <= width):
+                h = round(height * w / width)
+                name = f"{key}-{w}.jpg"
+                out_path = sized_dir / name
+                if not out_path.exists():
+                    tmp_path = out_path.with_name(f"{name}.{os.getpid()}.tmp")
+                    page.resize((w, h), Image.LANCZOS).save(tmp_path, format='JPEG', **JPEG_SETTINGS)
+                    tmp_path.replace(out_path)
+                variants.append([name, w, h])
+    return variants
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Read the site's PDFs and render previews of their first pages.")
+    parser.add_argument('--site', type=Path, default=DEFAULT_SITE, metavar='DIR',
+                        help="the site whose PDFs to read (default: %(default)s)")
+    parser.add_argument('--config', type=Path, metavar='FILE',
+                        help=f"read settings from this JSON file (default: {CONFIG_NAME} in the site, if any)")
+    parser.add_argument('--force', action=argparse.BooleanOptionalAction, default=False,
+                        help="read and render every PDF again, ignoring the cache")
+    args = parser.parse_args(argv)
+
+    # Settings from the config file become the defaults, and the command
+    # line is parsed again over them
+    config_path = args.config or args.site / CONFIG_NAME
+    if args.config is not None or config_path.exists():
+        try:
+            with open(config_path, 'r') as f:
+                config = json.load(f)
+        except (OSError, ValueError) as e:
+            raise SystemExit(f"Can't read {config_path}: {e}")
+        if not isinstance(config, dict):
+            raise SystemExit(f"{config_path} should hold a JSON object of settings")
+        settings = {}
+        for key, value in config.items():
+            name = key.replace('-', '_')
+            # The rest are generate-posts-v2.py's
+            if name not in vars(args) or name == 'config':
+                continue
+            if name == 'site' and isinstance(value, str):
+                value = str(config_path.parent / Path(value).expanduser())
+            settings[name] = value
+        parser.set_defaults(**settings)
+        args = parser.parse_args(argv)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    set_paths(args.site)
+
+    renderer = find_renderer()
+    if renderer is None:
+        print(f"Warning: no PDF renderer ({' or '.join(RENDERERS)}) found; writing metadata without previews")
+    elif Image is None:
+        print("Warning: Pillow is not installed; writing metadata without previews")
+        renderer = None
+
+    cache = {}
+    if cache_path.exists() and not args.force:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+
+    # Previews are named after a hash of the PDF, so they can be cached for
+    # good and a PDF is only read and rendered again when it changes
+    sources = sorted(site_dir.glob('*.pdf'))
+    sized_dir.mkdir(parents=True, exist_ok=True)
+    entries = {}
+    read = 0
+    for source in sources:
+        stat = source.stat()
+        source_stat = [stat.st_mtime_ns, stat.st_size]
+        entry = cache.get(source.name, {})
+        if entry.get('stat') != source_stat:
+            key = sha256_file(source)[:16]
+            if entry.get('key') != key:
+                # A PDF this can't parse is still listed, just without its details
+                try:
+                    details = read_pdf(source)
+                except ValueError as e:
+                    print(f"Warning: could not read {source}: {e}")
+                    details = {'title': None, 'pages': None}
+                entry = {'key': key, **details}
+                read += 1
+            entry['stat'] = source_stat
+        entries[source.name] = entry
+
+        variants = entry.get('variants')
+        if renderer is not None and (not variants or not all((sized_dir / name).exists() for name, _, _ in variants)):
+            try:
+                entry['variants'] = make_previews(renderer, source, entry['key'])
+            except (subprocess.CalledProcessError, OSError) as e:
+                print(f"Warning: could not render a preview of {source}: {e}")
+                continue
+            print(f"Created: {', '.join(name for name, _, _ in entry['variants'])} from {source}")
+
+    # Remove previews of PDFs that changed or are gone. Without a renderer
+    # the old previews still match their PDFs, so they are kept.
+    current = {name for entry in entries.values() for name, _, _ in entry.get('variants', [])}
+    for old_path in sized_dir.glob('*.jpg'):
+        if old_path.name not in current:
+            old_path.unlink()
+            print(f"Removed: {old_path}")
+
+    # Pages link to each PDF with its details, and a preview to show
+    # (lazily) before anyone fetches the whole file
+    manifest = {'sizes': PREVIEW_SIZES, 'pdfs': {}}
+    for source in sources:
+        entry = entries[source.name]
+        details = {
+            'href': source.name,
+            'title': entry['title'],
+            'pages': entry['pages'],
+            'bytes': entry['stat'][1],
+        }
+        variants = entry.get('variants')
+        if variants:
+            name, width, height = variants[0]
+            details.update({
+                'src': f"pdf-previews/sized/{name}",
+                'srcset': ', '.join(f"pdf-previews/sized/{n} {w}w" for n, w, _ in variants),
+                'width': width,
+                'height': height,
+            })
+        manifest['pdfs'][source.name] = details
+    manifest_json = json.dumps(manifest, indent=1) + '\n'
+    if not manifest_path.exists() or manifest_path.read_text() != manifest_json:
+        manifest_path.write_text(manifest_json)
+        print(f"Created: {manifest_path}")
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(cache_path, 'w') as f:
+        json.dump(entries, f, indent=1, sort_keys=True)
+
+    print(f"Done reading PDFs! ({read} read, {len(sources) - read} unchanged)")
+
+
+if __name__ == '__main__':
+    main()
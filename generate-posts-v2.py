@@ -1,510 +1,3357 @@
 #!/usr/bin/env python3
 
+import argparse
+import bisect
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import cProfile
 import csv
-from datetime import datetime
+from datetime import datetime, timezone
+import email.utils
+import filecmp
+import gzip
+import hashlib
+import html
+import importlib.util
+import http.server
+import io
+import itertools
+import json
+import os
 from pathlib import Path
+import posixpath
 import re
-
-# Paths
-csv_path = Path.home() / ".whorl/docs/goldenblue/posts.csv"
-html_dir = Path.home() / ".whorl/docs/goldenblue/posts"
-output_dir = Path("/home/kav/kaiwebsite/posts")
-
-# Create output directory
-output_dir.mkdir(exist_ok=True)
-
-# HTML template
-template = """<!DOCTYPE html>
-<html>
-<head>
-  <title>{title} - Kai</title>
-  <meta charset="UTF-8">
-  <meta name="viewport" content="width=device-width, initial-scale=1.0">
-  <link rel="stylesheet" href="https://use.typekit.net/xxz4zlr.css">
-  <script>
-    // Set theme immediately to avoid flash
-    (function() {{
-      const savedTheme = localStorage.getItem('theme') || 'dark';
-      if (savedTheme === 'light') {{
-        document.documentElement.setAttribute('data-theme', 'light');
-      }}
-    }})();
-  </script>
-  <style>
-    :root {{
-      --bg-color: #0a0a0a;
-      --text-color: white;
-      --border-color: white;
-      --heading-stroke: lightgoldenrodyellow;
-      --glow-color: lightgoldenrodyellow;
-      --marker-color: lightgray;
-      --backdrop-brightness: 0.5;
-      --button-hover-bg: rgb(255, 255, 255);
-      --button-hover-text: black;
-      --date-color: #aaa;
-    }}
-
-    :root[data-theme="light"] {{
-      --bg-color: #f5f5f5;
-      --text-color: #1a1a1a;
-      --border-color: #333;
-      --heading-stroke: rgba(244, 50, 8, 0.5);
-      --glow-color: rgba(244, 50, 8, 0.3);
-      --marker-color: #666;
-      --backdrop-brightness: 1.5;
-      --button-hover-bg: #1a1a1a;
-      --button-hover-text: white;
-      --date-color: #888;
-    }}
-
-    * {{
-      font-family: brigade, sans-serif;
-      font-weight: 500;
-      font-style: normal;
-      color: var(--text-color);
-      padding: 0;
-      margin: 0;
-      transition: background-color 0.3s ease, color 0.3s ease, border-color 0.3s ease, box-shadow 0.3s ease;
-    }}
-
-    h1, h2, h3, h4, h5, h6 {{
-      font-family: "waters-titling-condensedpro", sans-serif;
-      font-weight: 600;
-      font-style: normal;
-      -webkit-text-stroke-width: 0.5px;
-      -webkit-text-stroke-color: var(--heading-stroke);
-    }}
-
-    h1 {{
-      font-size: 13.2ch;
-      text-shadow: 0px 0px 5px var(--glow-color);
-      padding-top: 0.55rem;
-      padding-bottom: 0rem;
-      margin-left: 3px;
-    }}
-
-    @media screen and (max-width: 80ch) {{
-      h1 {{
-        font-size: 19.25vw;
-      }}
-    }}
-
-    .red-drop {{
-      text-shadow: 0px 0px 5px var(--glow-color), 9px 6px 0px #F43208;
-    }}
-
-    .red-raise {{
-      text-shadow: 0px 0px 5px var(--glow-color), -9px -6px 0px #F43208;
-    }}
-
-    .header-container {{
-      padding-bottom: 0;
-    }}
-
-    h2 {{
-      font-size: 2.2rem;
-      margin-bottom: 0.55rem;
-    }}
-
-    h3 {{
-      font-size: 1.5rem;
-      margin-top: 1.1rem;
-      margin-bottom: 0.55rem;
-    }}
-
-    p {{
-      font-size: 1.1rem;
-      padding-top: 0.55rem;
-      padding-bottom: 0.55rem;
-      line-height: 1.6;
-    }}
-
-    em {{
-      font-style: italic;
-    }}
-
-    a {{
-      text-underline-offset: 0.25rem;
-      text-decoration-color: #F43208;
-      color: var(--text-color);
-    }}
-
-    blockquote {{
-      border-left: 3px solid var(--border-color);
-      padding-left: 1.1rem;
-      margin: 1.1rem 0;
-      font-style: italic;
-    }}
-
-    .post-date {{
-      font-style: italic;
-      color: var(--date-color);
-      font-size: 1rem;
-      margin-bottom: 1.65rem;
-      display: block;
-    }}
-
-    canvas {{
-      position: absolute;
-      top: 0;
-      left: 0;
-      z-index: -1;
-    }}
-
-    body {{
-      overflow-x: clip;
-      background-color: var(--bg-color);
-    }}
-
-    .container {{
-      margin: auto;
-      margin-top: unset;
-      margin-bottom: unset;
-      max-width: 71.5ch;
-      padding: 0.55rem;
-    }}
-
-    button {{
-      background-color: transparent;
-      color: var(--text-color);
-      border: 1px solid var(--border-color);
-      padding: 0.55rem;
-      font-size: 1.1rem;
-      cursor: pointer;
-      margin-top: 0.55rem;
-      margin-bottom: 0.55rem;
-      backdrop-filter: blur(10px) brightness(var(--backdrop-brightness));
-    }}
-
-    button:hover:not(:disabled) {{
-      background-color: var(--button-hover-bg);
-      color: var(--button-hover-text);
-    }}
-
-    .dashed {{
-      border: 1px dashed var(--border-color);
-      box-sizing: border-box;
-    }}
-
-    .backdrop {{
-      backdrop-filter: blur(10px) brightness(var(--backdrop-brightness));
-    }}
-
-    .menu-bar {{
-      display: flex;
-      justify-content: space-between;
-      gap: 0.55rem;
-      margin-bottom: 1rem;
-      flex-wrap: wrap;
-      padding-top: 0;
-      padding-bottom: 0;
-    }}
-
-    .menu-bar button {{
-      flex: 1;
-      margin-top: 0;
-      margin-bottom: 0;
-    }}
-
-    #theme-toggle {{
-      font-size: 1.2rem;
-      line-height: 1;
-    }}
-
-    .menu-bar button.active {{
-      box-shadow: 4px 4px 0px 0px #F43208;
-    }}
-
-    .post-content {{
-      padding: 1.1rem;
-    }}
-
-    .content img {{
-      max-width: 100%;
-      height: auto;
-      display: block;
-      margin: 1.1rem 0;
-    }}
-
-    .content a {{
-      display: inline;
-    }}
-
-    .content a img {{
-      cursor: pointer;
-    }}
-
-    .post-navigation {{
-      display: flex;
-      justify-content: space-between;
-      align-items: center;
-      margin-top: 1.1rem;
-      margin-bottom: 1.1rem;
-      gap: 1.1rem;
-    }}
-
-    .nav-arrow {{
-      display: flex;
-      align-items: center;
-      gap: 0.55rem;
-      text-decoration: none;
-      color: var(--text-color);
-      opacity: 0.7;
-      transition: opacity 0.2s;
-    }}
-
-    .nav-arrow:hover {{
-      opacity: 1;
-    }}
-
-    .nav-arrow .arrow {{
-      font-size: 1.5rem;
-    }}
-
-    .nav-arrow .nav-title {{
-      font-style: italic;
-      font-size: 0.95rem;
-    }}
-
-    .prev-post {{
-      justify-content: flex-start;
-    }}
-
-    .next-post {{
-      justify-content: flex-end;
-      margin-left: auto;
-    }}
-
-    .footnote {{
-      margin-top: 1.1rem;
-      padding-top: 0.55rem;
-      border-top: 1px solid var(--border-color);
-      font-size: 0.95rem;
-    }}
-
-    .footnote-anchor {{
-      vertical-align: super;
-      font-size: 0.8rem;
-      text-decoration: none;
-    }}
-
-    hr {{
-      border: none;
-      border-top: 1px solid var(--border-color);
-      margin: 1.1rem 0;
-    }}
-  </style>
-</head>
-<body>
-  <canvas id="starfield"></canvas>
-
-  <nav class="menu-bar container" style="margin-top: 1.65rem;">
-    <button id="home-btn">home</button>
-    <button id="writing-btn" class="active">writing</button>
-    <button id="gallery-btn">gallery</button>
-    <button id="collection-btn">collection</button>
-    <button id="theme-toggle">☀</button>
-  </nav>
-
-  <div class="container post-navigation">
-    <a href="{prev_link}" class="nav-arrow prev-post"{prev_style}>
-      <span class="arrow">←</span>
-      <span class="nav-title">{prev_title}</span>
-    </a>
-    <a href="{next_link}" class="nav-arrow next-post"{next_style}>
-      <span class="nav-title">{next_title}</span>
-      <span class="arrow">→</span>
-    </a>
-  </div>
-
-  <div class="container dashed backdrop">
-    <div class="post-content">
-      <h2>{title}</h2>
-      <span class="post-date">{date}</span>
-      <div class="content">
-{content}
-      </div>
-    </div>
-  </div>
-
-  <div class="container" style="margin-top: 1.1rem; margin-bottom: 1.65rem;">
-    <button id="return-to-top">↑ return to top</button>
-  </div>
-
-  <script src="../starfield.js"></script>
-  <script src="../light-starfield.js"></script>
-  <script>
-    const themeToggle = document.getElementById('theme-toggle');
-    const root = document.documentElement;
-
-    function initTheme() {{
-      const savedTheme = localStorage.getItem('theme') || 'dark';
-      if (savedTheme === 'light') {{
-        themeToggle.textContent = '☽';
-        window.starfield.stop();
-        window.lightStarfield.start();
-      }} else {{
-        themeToggle.textContent = '☀';
-        window.lightStarfield.stop();
-        window.starfield.start();
-      }}
-    }}
-
-    function setTheme(theme) {{
-      if (theme === 'light') {{
-        root.setAttribute('data-theme', 'light');
-        themeToggle.textContent = '☽';
-        window.starfield.stop();
-        window.lightStarfield.start();
-      }} else {{
-        root.removeAttribute('data-theme');
-        themeToggle.textContent = '☀';
-        window.lightStarfield.stop();
-        window.starfield.start();
-      }}
-      localStorage.setItem('theme', theme);
-    }}
-
-    function toggleTheme() {{
-      const current = root.getAttribute('data-theme') === 'light' ? 'light' : 'dark';
-      setTheme(current === 'dark' ? 'light' : 'dark');
-    }}
-
-    themeToggle.addEventListener('click', toggleTheme);
-    initTheme();
-
-    document.getElementById('home-btn').addEventListener('click', () => window.location.href = '../index.html');
-    document.getElementById('writing-btn').addEventListener('click', () => window.location.href = '../writing.html');
-    document.getElementById('gallery-btn').addEventListener('click', () => window.location.href = '../gallery.html');
-    document.getElementById('collection-btn').addEventListener('click', () => window.location.href = '../collection.html');
-    document.getElementById('return-to-top').addEventListener('click', () => window.scrollTo({{ top: 0, behavior: 'smooth' }}));
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+import urllib.parse
+import urllib.request
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:
+    Image = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Paths. Everything the build reads and writes is found from these three;
+# --site, --csv and --sources or a config file move them.
+DEFAULT_CSV = Path.home() / ".whorl/docs/goldenblue/posts.csv"
+DEFAULT_SOURCES = Path.home() / ".whorl/docs/goldenblue/posts"
+DEFAULT_SITE = Path("/home/kav/kaiwebsite")
+
+
+def set_paths(site=DEFAULT_SITE, csv_file=DEFAULT_CSV, sources=DEFAULT_SOURCES):
+    """Point the build at a site, a posts.csv and a directory of exports.
+
+    Every path under the site follows it. Worker processes are given the
+    same paths by worker_pool().
+    """
+    global csv_path, html_dir, site_dir, output_dir, index_path, templates_dir, assets_dir, images_dir
+    global image_cache_dir, manifest_path, profile_path, compressed_path, search_dir, search_cache_dir
+    global content_cache_dir, markdown_cache_dir, feed_path, rss_path, sitemap_path, lastmod_path, checked_path
+    global daemon_socket_path, trigger_path, preview_dir, preview_manifest_path
+    csv_path = Path(csv_file)
+    html_dir = Path(sources)
+    site_dir = Path(site)
+    output_dir = site_dir / "posts"
+    index_path = site_dir / "writing.html"
+    templates_dir = site_dir / "templates"
+    assets_dir = site_dir / "assets"
+    images_dir = site_dir / "images"
+    image_cache_dir = site_dir / ".build-cache/images"
+    manifest_path = site_dir / ".build-cache/manifest.json"
+    profile_path = site_dir / ".build-cache/profile.json"
+    compressed_path = site_dir / ".build-cache/compressed.json"
+    search_dir = site_dir / "search"
+    search_cache_dir = site_dir / ".build-cache/search"
+    content_cache_dir = site_dir / ".build-cache/content"
+    markdown_cache_dir = site_dir / ".build-cache/markdown"
+    feed_path = site_dir / "feed.xml"
+    rss_path = site_dir / "rss.xml"
+    sitemap_path = site_dir / "sitemap.xml"
+    lastmod_path = site_dir / ".build-cache/lastmod.json"
+    checked_path = site_dir / ".build-cache/checked.json"
+    daemon_socket_path = site_dir / ".build-cache/daemon.sock"
+    trigger_path = site_dir / ".build-cache/rebuild"
+    preview_dir = site_dir / "preview"
+    preview_manifest_path = site_dir / ".build-cache/preview.json"
+
+
+set_paths()
+
+
+def worker_pool(workers):
+    # Workers started by spawn (the default on macOS) import this file
+    # afresh, so they're handed the paths in use
+    return ProcessPoolExecutor(max_workers=workers, initializer=set_paths,
+                               initargs=(site_dir, csv_path, html_dir))
+
+# Settings can also come from a JSON file, build.json in the site unless
+# --config names another. Its keys are the long options ("feed-posts": 50,
+# "minify": true); the command line overrides it. These settings are paths,
+# taken relative to the file.
+CONFIG_NAME = 'build.json'
+CONFIG_PATHS = ('site', 'csv', 'sources', 'image_source', 'profile', 'cprofile', 'trigger')
+
+# The post list in writing.html sits between these markers; the rest of the
+# page is maintained by hand
+INDEX_START = '<!-- post index: generated by generate-posts-v2.py -->'
+INDEX_END = '<!-- end post index -->'
+# So does the search box, which is only there while search/ holds the index
+# it queries
+# And so do the links to the feeds, which every build writes along with the
+# page
+FEED_START = '<!-- feed links: generated by generate-posts-v2.py -->'
+FEED_END = '<!-- end feed links -->'
+FEED_LINKS = '''
+  <link rel="alternate" type="application/atom+xml" title="Kai - Writing" href="./feed.xml">
+  <link rel="alternate" type="application/rss+xml" title="Kai - Writing" href="./rss.xml">
+  '''
+SEARCH_START = '<!-- search box: generated by generate-posts-v2.py -->'
+SEARCH_END = '<!-- end search box -->'
+SEARCH_BOX = '''
+      <input id="search" type="search" placeholder="search posts" aria-label="Search posts">
+      <ul id="search-results" hidden></ul>
+      <script src="./search.js" defer></script>
+      '''
+
+MANIFEST_VERSION = 1
+
+# The page template for posts, in templates/
+POST_TEMPLATE = 'post.html'
+
+# Hand-written scripts every page loads; --precompress covers them along
+# with the generated pages and assets
+SHARED_SCRIPTS = ('starfield.js', 'light-starfield.js', 'clouds.js', 'search.js')
+
+# The search index is split into this many files by a hash of each term, so
+# a query only downloads the parts holding its terms. search.js has to
+# agree on the number and the hash.
+SEARCH_SHARDS = 32
+SEARCH_TAG = re.compile(r'<[^>]*>')
+SEARCH_TOKEN = re.compile(r'\w+')
+
+# parse_content splits a post at its top-level elements, and names each
+# block by the element's first class or else its tag
+CONTENT_TAG = re.compile(r'<(?:!--.*?-->|(/?)([a-zA-Z][\w:-]*)[^>]*>)', re.DOTALL)
+CONTENT_VOID = frozenset(('area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+                          'source', 'track', 'wbr'))
+CONTENT_CLASSES = {
+    'captioned-image-container': 'image',
+    'image-link': 'image',
+    'image-gallery-embed': 'image',
+    'footnote': 'footnote',
+}
+CONTENT_TAGS = {
+    'p': 'paragraph',
+    'h1': 'heading', 'h2': 'heading', 'h3': 'heading', 'h4': 'heading', 'h5': 'heading', 'h6': 'heading',
+    'pre': 'pre',
+    'blockquote': 'quote',
+    'ul': 'list', 'ol': 'list',
+    'hr': 'rule',
+    'figure': 'image', 'picture': 'image', 'img': 'image',
+}
+CONTENT_CLASS = re.compile(r'\bclass="([^"]*)"')
+# Substack puts its section breaks in a bare <div>
+CONTENT_RULE = re.compile(r'<div>\s*<hr[^>]*>\s*</div>')
+CONTENT_IMG = re.compile(r'<img\b[^>]*>')
+CONTENT_CAPTION = re.compile(r'<figcaption\b[^>]*>(.*?)</figcaption>', re.DOTALL)
+CONTENT_LINK = re.compile(r'<a\s[^>]*\bhref="([^"]*)"')
+CONTENT_FOOTNOTE = re.compile(r'<a\b[^>]*class="footnote-number"[^>]*>(.*?)</a>', re.DOTALL)
+
+# A post can be written in Markdown instead: <post_id>.md, or <slug>.md as
+# generate-posts.py had it, next to the Substack exports. Its HTML is cached
+# in .build-cache/markdown/ under a hash of the source and this version,
+# which changes whenever convert_markdown's output does.
+MARKDOWN_VERSION = 2
+MARKDOWN_FENCE = re.compile(r' {0,3}(`{3,}|~{3,})[ \t]*([^`\s]*)[^`]*$')
+MARKDOWN_HEADING = re.compile(r' {0,3}(#{1,6})(?:[ \t]+(.*?))?(?:[ \t]+#+)?[ \t]*$')
+MARKDOWN_SETEXT = re.compile(r' {0,3}(=+|-+)[ \t]*$')
+MARKDOWN_RULE = re.compile(r' {0,3}([-*_])(?:[ \t]*\1){2,}[ \t]*$')
+MARKDOWN_QUOTE = re.compile(r' {0,3}> ?')
+MARKDOWN_ITEM = re.compile(r'( {0,3})([-*+]|(\d{1,9})[.)])([ \t]+|$)')
+MARKDOWN_HTML = re.compile(r' {0,3}<(?:!--|/?[a-zA-Z][\w-]*(?:[\s/>]|$))')
+MARKDOWN_FOOTNOTE = re.compile(r' {0,3}\[\^([^\]\s]+)\]:[ \t]*(.*)$')
+MARKDOWN_REFERENCE = re.compile(r' {0,3}\[([^\]^][^\]]*)\]:[ \t]*<?([^\s>]+)>?(?:[ \t]+("[^"]*"|\'[^\']*\'|\([^)]*\)))?[ \t]*$')
+# Pieces of a line that are kept away from the inline rules, in this order
+MARKDOWN_PROTECTED = re.compile(
+    r'(?P<code>(`+)(.+?)(?<!`)\2(?!`))'
+    r'|(?P<br>(?: {2,}|\\)\n)'
+    r'|\\(?P<escape>[!"#$%&\'()*+,\-./:;<=>?@\[\\\]^_`{|}~])'
+    r'|<(?P<autolink>https?://[^\s<>]+|[^\s<>@]+@[^\s<>@]+\.[^\s<>@]+)>'
+    r'|(?P<html><!--.*?-->|</?[a-zA-Z][\w-]*(?:\s[^<>]*)?/?>|&(?:#\d+|#[xX][0-9a-fA-F]+|\w+);)',
+    re.DOTALL)
+MARKDOWN_DESTINATION = r'\(\s*(<[^>]*>|[^\s)]+)(?:\s+("[^"]*"|\'[^\']*\'|\([^)]*\)))?\s*\)'
+MARKDOWN_LINK_TEXT = r'\[((?:[^\[\]]|\[[^\[\]]*\])*)\]'
+MARKDOWN_IMAGE = re.compile(r'!\[([^\[\]]*)\](?:' + MARKDOWN_DESTINATION + r'|\[([^\]]*)\])')
+MARKDOWN_LINK = re.compile(MARKDOWN_LINK_TEXT + r'(?:' + MARKDOWN_DESTINATION + r'|\[([^\]]*)\])?')
+MARKDOWN_EMPHASIS = [
+    (re.compile(r'\*\*\*(?=\S)(.+?)(?<=\S)\*\*\*', re.DOTALL), r'<strong><em>\1</em></strong>'),
+    (re.compile(r'\*\*(?=\S)(.+?)(?<=\S)\*\*', re.DOTALL), r'<strong>\1</strong>'),
+    (re.compile(r'(?<!\w)__(?=\S)(.+?)(?<=\S)__(?!\w)', re.DOTALL), r'<strong>\1</strong>'),
+    (re.compile(r'\*(?=\S)(.+?)(?<=\S)\*', re.DOTALL), r'<em>\1</em>'),
+    (re.compile(r'(?<!\w)_(?=\S)(.+?)(?<=\S)_(?!\w)', re.DOTALL), r'<em>\1</em>'),
+    (re.compile(r'~~(?=\S)(.+?)(?<=\S)~~', re.DOTALL), r'<s>\1</s>'),
+]
+MARKDOWN_PLACEHOLDER = re.compile(r'\x00(\d+)\x00')
+
+# The feeds and the sitemap need absolute links
+SITE_URL = 'https://kai.bleebo.dev/'
+FEED_TITLE = 'Kai - Writing'
+FEED_AUTHOR = 'Kai van Brunt'
+# With --feed-summary, a post's entry is the start of its text, cut at a word
+FEED_SUMMARY_LENGTH = 300
+# Hand-written pages the sitemap lists along with the posts
+SITEMAP_PAGES = ('index.html', 'writing.html', 'gallery.html', 'collection.html')
+# Characters XML 1.0 doesn't allow, even escaped
+XML_INVALID = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+# What `check` follows out of a page: the URLs in these tags' href, src
+# and srcset, and literal URLs that scripts navigate to or fetch
+CHECK_TAG = re.compile(r'<(a|link|script|img|source|iframe|video|audio|embed)\b[^>]*>', re.IGNORECASE)
+CHECK_ATTRIBUTE = re.compile(r'[ \t\n\r\f](href|src|srcset)[ \t\n\r\f]*=[ \t\n\r\f]*("[^"]*"|\'[^\']*\')',
+                             re.IGNORECASE)
+CHECK_ID = re.compile(r'[ \t\n\r\f](?:id|name)="([^"]*)"')
+CHECK_SCRIPT = re.compile(r'location\.href\s*=\s*([\'"])([^\'"]+)\1|fetch\(\s*([\'"])([^\'"]+)\3\s*\)')
+# Links with a scheme (https:, mailto:, data:) or a host are off the site
+CHECK_EXTERNAL = re.compile(r'[a-zA-Z][\w+.-]*:|//')
+# Files bigger than this get reported, by type; PDFs are left alone
+CHECK_SIZE_LIMITS = {
+    '.html': 512 * 1024,
+    '.css': 128 * 1024,
+    '.js': 128 * 1024,
+    '.json': 512 * 1024,
+    '.xml': 1024 * 1024,
+    '.jpg': 1024 * 1024,
+    '.jpeg': 1024 * 1024,
+    '.png': 1024 * 1024,
+    '.gif': 1024 * 1024,
+    '.webp': 1024 * 1024,
+    '.avif': 1024 * 1024,
+}
+
+# Part of a --minify page's render inputs: bump it whenever minify_content
+# or minify_page changes its output, so pages minified before get redone
+MINIFY_VERSION = 3
+
+# The rest of a tag after its name, up to the > that ends it. A quoted value
+# is taken whole, since it can hold a > of its own.
+MINIFY_TAG_END = r'(?:[^>"\']|"[^"]*"|\'[^\']*\')*>'
+
+# --minify leaves the inside of these exactly as it is: whitespace in a
+# <pre> is the poem's layout, and in the others it can mean something
+MINIFY_KEEP = re.compile(rf'(<(pre|textarea|script|style)\b{MINIFY_TAG_END})(.*?)(?=</\2[ \t\n\r\f]*>)',
+                         re.DOTALL | re.IGNORECASE)
+MINIFY_COMMENT = re.compile(r'<!--.*?-->', re.DOTALL)
+# HTML whitespace only: a no-break space is text
+MINIFY_SPACE = re.compile(r'[ \t\n\r\f]+')
+# Whitespace next to a block-level tag never shows
+MINIFY_BLOCK = re.compile(
+    r'[ \t\n\r\f]*(</?(?:html|head|body|title|meta|link|script|style|div|p|h[1-6]|ul|ol|li|blockquote'
+    r'|figure|figcaption|source|hr|nav|section|article|header|footer|main|table|thead|tbody|tr|td|th|pre)'
+    rf'\b{MINIFY_TAG_END})[ \t\n\r\f]*', re.IGNORECASE)
+# Substack wrappers left bare and empty once the cleanup rules have run and
+# their data-* attributes are gone. An empty <p> is a blank line in the post,
+# and anything with a class or id may be styled or looked for by a script.
+MINIFY_EMPTY = re.compile(r'<(div|span)>[ \t\n\r\f]*</\1>')
+MINIFY_TAG = re.compile(rf'(<[a-zA-Z][^ \t\n\r\f/>]*)({MINIFY_TAG_END})')
+MINIFY_ATTRIBUTE = re.compile(r'[ \t\n\r\f]+([^ \t\n\r\f=/>]+)(?:=("[^"]*"|\'[^\']*\'|[^ \t\n\r\f>]*))?')
+# Attributes that only restate the default. Substack's data-* attributes go
+# too: they hold state for its own scripts, and nothing here reads them.
+MINIFY_DEFAULTS = {
+    ('type', '"text/javascript"'),
+    ('type', '"text/css"'),
+    ('xmlns', '"http://www.w3.org/2000/svg"'),
+}
+# Substack gives each image a WebP <source> and an <img> whose srcset asks
+# the CDN for the same widths in whatever format the browser accepts
+MINIFY_CDN_SOURCE = re.compile(
+    r'<source type="image/webp" srcset="([^"]*)"[^>]*>[ \t\n\r\f]*(?=<img\b[^>]*[ \t\n\r\f]srcset="([^"]*)")')
+
+# Shared files every post page links to. Each is published into assets/
+# under a name containing a hash of its content, so it can be cached forever.
+POST_ASSETS = {'stylesheet': 'post.css', 'script': 'post.js'}
+# Scripts from the site's root that post pages load too, published the same
+# way; the hand-written pages keep loading the originals
+PAGE_SCRIPTS = {'starfield': 'starfield.js', 'light_starfield': 'light-starfield.js'}
+
+# Where Substack keeps post images, and the CDN it serves resized copies from
+SUBSTACK_IMAGES = 'https://substack-post-media.s3.amazonaws.com/'
+SUBSTACK_CDN = 'https://substackcdn.com/image/fetch/'
+
+# Widths and encoder settings for mirrored images; the widths match the
+# srcset Substack itself uses
+IMAGE_WIDTHS = (424, 848, 1272, 1456)
+IMAGE_FORMATS = {
+    'avif': {'quality': 60},
+    'webp': {'quality': 80, 'method': 6},
+}
+IMAGE_SIZES = '(min-width: 71.5ch) 71.5ch, 100vw'
+
+# Manifest fields that feed into a rendered page
+RENDER_INPUTS = ('source', 'markdown', 'row', 'prev', 'next', 'images', 'minify')
+
+# `serve` adds this to every page it sends, so open pages reload themselves
+# when something they show changes
+LIVE_RELOAD_PATH = '/__live-reload'
+LIVE_RELOAD_SCRIPT = f"""  <script>
+    // Added by generate-posts-v2.py serve
+    new EventSource('{LIVE_RELOAD_PATH}').onmessage = function(event) {{
+      const changed = JSON.parse(event.data);
+      if (changed.includes('*') || changed.includes(location.pathname)) location.reload();
+    }};
   </script>
-</body>
-</html>
 """
 
-# Read all posts first to build navigation
-posts = []
-with open(csv_path, 'r') as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        if row['is_published'] != 'true':
+# How often `serve --watch` checks the sources for changes, in seconds, and
+# `daemon` its trigger file
+WATCH_INTERVAL = 0.1
+
+# The daemon ends its reply to each request with a line holding this and
+# the build's exit status
+DAEMON_STATUS = '\x00status '
+
+
+def sha256(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+class CleanupRule:
+    """A single cleanup substitution.
+
+    Most rules delete an element: `open` matches its start tag and `close`
+    whatever ends it, with the shortest possible body in between. Rules
+    without a `close` match `open` alone.
+    """
+
+    def __init__(self, name, open, close=None, replacement='', flags=0):
+        if not open.startswith('<'):
+            raise ValueError(f"cleanup rule {name!r} must start at a tag")
+        self.name = name
+        self.open = open
+        self.flags = flags
+        self.replacement = replacement
+        pattern = open if close is None else f'(?P<open>{open}).*?(?P<close>{close})'
+        self.regex = re.compile(pattern, flags | re.DOTALL)
+        self.open_regex = re.compile(open, flags)
+        self.close_regex = re.compile(close, flags | re.DOTALL) if close is not None else None
+        self.has_close = close is not None
+
+
+class CleanupEngine:
+    """Applies a list of cleanup rules in a single pass over a document.
+
+    All the rules' start tags are combined into one alternation, so the regex
+    engine finds every candidate position in one scan and the named group
+    that matched says which rule to try first. The result is the same as
+    running each rule's re.sub over the whole document in list order: at a
+    candidate the rules are tried in that order and the first match wins.
+    Inputs where the order of whole-document passes may matter are handed
+    to the sequential passes instead: an earlier rule's start tag inside a
+    later rule's match (the earlier pass could change what the later one
+    sees), or a later rule's start tag running into a replacement, counting
+    from the text as already rewritten. Substack nests rules that way in
+    its subscribe widgets and image buttons, so most exports with either
+    fall back.
+    """
+
+    # How far either side of a replacement to look for a later rule's start tag
+    PROBE_WINDOW = 256
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        alternatives = []
+        for index, rule in enumerate(self.rules):
+            scope = '(?i:' if rule.flags & re.IGNORECASE else '(?:'
+            alternatives.append(f'(?P<rule{index}>{scope}{rule.open[1:]}))')
+        # Every rule starts at a '<'; keeping it outside the alternation lets
+        # the regex engine skip straight from one '<' to the next
+        self.scanner = re.compile('<(?:' + '|'.join(alternatives) + ')')
+        self.fallbacks = 0
+
+    def match_at(self, text, at, first, stats=None, before=None):
+        # Try the rules from the first whose start tag matched, in order
+        end = len(self.rules) if before is None else before
+        for index in range(first, end):
+            rule = self.rules[index]
+            if stats is None:
+                m = rule.regex.match(text, at)
+            else:
+                started = time.perf_counter()
+                m = rule.regex.match(text, at)
+                record = stats.setdefault(rule.name, [0, 0.0, 0])
+                record[1] += time.perf_counter() - started
+                if m:
+                    record[0] += 1
+                    record[2] += m.end() - m.start() - len(rule.replacement)
+            if m:
+                return index, m
+        return None
+
+    def overlaps_earlier_rule(self, text, index, m):
+        # Could an earlier rule, run first, have changed this match? Its pass
+        # may rewrite part of the match, and a start tag that matches nothing
+        # here may match once some other pass has closed a gap further on,
+        # so any earlier rule's start tag inside the match counts
+        candidate = self.scanner.search(text, m.start() + 1)
+        while candidate and candidate.start() < m.end():
+            if int(candidate.lastgroup[4:]) < index:
+                return True
+            candidate = self.scanner.search(text, candidate.start() + 1)
+        return False
+
+    def completes_later_rule(self, tail, text, index, m):
+        # Would a later rule's start tag match across this rule's
+        # replacement? `tail` is the end of the rewritten text before the
+        # match, which is what the later pass would see. A start tag there
+        # that the later rule didn't match may match once the removal
+        # closes the gap, or find a different close.
+        later = self.rules[index + 1:]
+        if not later:
+            return False
+        replacement = self.rules[index].replacement
+        probe = tail + replacement + text[m.end():m.end() + self.PROBE_WINDOW]
+        splice = len(tail)
+        at = probe.find('<')
+        while at != -1 and at < splice + len(replacement):
+            for rule in later:
+                found = rule.open_regex.match(probe, at)
+                if found and (at >= splice or found.end() > splice or rule.has_close):
+                    return True
+            at = probe.find('<', at + 1)
+        return False
+
+    def output_tail(self, pieces):
+        # The last PROBE_WINDOW characters of the output so far
+        tail = []
+        size = 0
+        for piece in reversed(pieces):
+            tail.append(piece[-(self.PROBE_WINDOW - size):])
+            size += len(tail[-1])
+            if size >= self.PROBE_WINDOW:
+                break
+        return ''.join(reversed(tail))
+
+    def clean_sequential(self, text, stats=None):
+        for rule in self.rules:
+            started = time.perf_counter()
+            size = len(text)
+            text, count = rule.regex.subn(rule.replacement, text)
+            if stats is not None:
+                record = stats.setdefault(rule.name, [0, 0.0, 0])
+                record[0] += count
+                record[1] += time.perf_counter() - started
+                record[2] += size - len(text)
+        return text
+
+    def clean(self, text, stats=None):
+        # Collect stats locally so a fallback doesn't count matches twice
+        local = None if stats is None else {}
+        pieces = []
+        emitted = 0
+        candidate = self.scanner.search(text)
+        while candidate:
+            at = candidate.start()
+            found = self.match_at(text, at, int(candidate.lastgroup[4:]), local)
+            if found is None:
+                candidate = self.scanner.search(text, at + 1)
+                continue
+            index, m = found
+            pieces.append(text[emitted:at])
+            if (self.overlaps_earlier_rule(text, index, m)
+                    or self.completes_later_rule(self.output_tail(pieces), text, index, m)):
+                self.fallbacks += 1
+                if stats is not None:
+                    for name, (_, seconds, _) in local.items():
+                        stats.setdefault(name, [0, 0.0, 0])[1] += seconds
+                return self.clean_sequential(text, stats)
+            pieces.append(self.rules[index].replacement)
+            emitted = m.end()
+            candidate = self.scanner.search(text, emitted)
+        pieces.append(text[emitted:])
+        if stats is not None:
+            for name, (matches, seconds, removed) in local.items():
+                record = stats.setdefault(name, [0, 0.0, 0])
+                record[0] += matches
+                record[1] += seconds
+                record[2] += removed
+        return ''.join(pieces)
+
+
+CLEANUP_RULES = [
+    # Remove preformatted-block wrapper and class="text"
+    CleanupRule('preformatted-wrapper', r'<div class="preformatted-block"[^>]*><label[^>]*>',
+                r'</label><pre class="text">', replacement='<pre>'),
+    CleanupRule('preformatted-close', r'</pre></div>', replacement='</pre>'),
+    CleanupRule('pre-text-class', r'<pre class="text">', replacement='<pre>'),
+
+    # Remove subscription prompts and buttons
+    CleanupRule('thanks-for-reading', r'<p[^>]*>Thanks for reading', r'</p>', flags=re.IGNORECASE),
+    CleanupRule('subscription-div', r'<div[^>]*class="[^"]*subscription[^"]*"[^>]*>', r'</div>', flags=re.IGNORECASE),
+    CleanupRule('subscribe-button', r'<button[^>]*subscribe[^>]*>', r'</button>', flags=re.IGNORECASE),
+    CleanupRule('subscribe-link', r'<a[^>]*subscribe[^>]*>', r'</a>', flags=re.IGNORECASE),
+
+    # Remove Spotify embeds
+    CleanupRule('spotify-iframe', r'<iframe[^>]*spotify\.com[^>]*>', r'</iframe>', flags=re.IGNORECASE),
+    CleanupRule('spotify-div', r'<div[^>]*class="[^"]*spotify[^"]*"[^>]*>', r'</div>', flags=re.IGNORECASE),
+
+    # Remove image open buttons (Substack adds these)
+    CleanupRule('open-image-button', r'<button[^>]*>Open image', r'</button>', flags=re.IGNORECASE),
+    CleanupRule('image-link-button', r'<a[^>]*class="[^"]*image-link[^"]*"[^>]*>\s*<button[^>]*>',
+                r'</button>\s*</a>', flags=re.IGNORECASE),
+    CleanupRule('image-button-div', r'<div[^>]*class="[^"]*image-button[^"]*"[^>]*>', r'</div>', flags=re.IGNORECASE),
+]
+
+cleanup = CleanupEngine(CLEANUP_RULES)
+
+
+def clean_content(content, slug, stats=None, sequential=False):
+    if sequential:
+        content = cleanup.clean_sequential(content, stats)
+    else:
+        content = cleanup.clean(content, stats)
+
+    # Fix "Another Arctic" formatting - add leading spaces to "I."
+    if slug == 'another-arctic':
+        content = content.replace('<pre>I.\n\n', '<pre>      I.\n\n')
+
+    return content
+
+
+class MarkdownConverter:
+    """Converts one Markdown post into HTML shaped like a Substack export.
+
+    Paragraphs, headings, fenced and indented code, blockquotes, lists,
+    rules, raw HTML, links (inline and by reference), images, emphasis and
+    footnotes. Blocks come out the way Substack writes them, so
+    parse_content, the feeds and the page styles treat both kinds of post
+    alike: a paragraph's own line is its image's caption, rules sit in a
+    bare <div>, list items hold paragraphs, and footnotes use Substack's
+    anchors and classes.
+    """
+
+    def __init__(self, text):
+        self.references = {}
+        self.footnotes = {}
+        self.order = []
+        lines = self.collect_definitions(text.replace('\x00', '').replace('\r\n', '\n').expandtabs(4).split('\n'))
+        self.blocks = self.convert_blocks(lines)
+
+    def html(self):
+        # Footnote texts can cite other footnotes, so the list can grow
+        # while it's being written
+        blocks = list(self.blocks)
+        i = 0
+        while i < len(self.order):
+            number = i + 1
+            body = ''.join(self.convert_blocks(self.footnotes[self.order[i]]))
+            blocks.append(f'<div class="footnote"><a id="footnote-{number}" href="#footnote-anchor-{number}" '
+                          f'class="footnote-number" target="_self">{number}</a>'
+                          f'<div class="footnote-content">{body}</div></div>')
+            i += 1
+        return ''.join(blocks)
+
+    def collect_definitions(self, lines):
+        # Take out footnote texts and link references, which can be defined
+        # anywhere; a footnote goes on over indented lines
+        kept = []
+        i = 0
+        in_fence = None
+        while i < len(lines):
+            line = lines[i]
+            fence = MARKDOWN_FENCE.match(line)
+            if fence and (in_fence is None or line.strip().startswith(in_fence)):
+                in_fence = fence.group(1) if in_fence is None else None
+            if in_fence is not None:
+                kept.append(line)
+                i += 1
+                continue
+            footnote = MARKDOWN_FOOTNOTE.match(line)
+            reference = MARKDOWN_REFERENCE.match(line)
+            if footnote:
+                body = [footnote.group(2)]
+                i += 1
+                while i < len(lines) and (lines[i].startswith('    ') or not lines[i].strip()
+                                          and i + 1 < len(lines) and lines[i + 1].startswith('    ')):
+                    body.append(lines[i][4:])
+                    i += 1
+                self.footnotes.setdefault(footnote.group(1), body)
+                continue
+            if reference:
+                title = reference.group(3)
+                self.references.setdefault(reference.group(1).lower(),
+                                           (reference.group(2), title[1:-1] if title else None))
+                i += 1
+                continue
+            kept.append(line)
+            i += 1
+        return kept
+
+    def starts_block(self, line):
+        # Whether a line ends the paragraph before it
+        item = MARKDOWN_ITEM.match(line)
+        return bool(MARKDOWN_HEADING.match(line) or MARKDOWN_FENCE.match(line) or MARKDOWN_QUOTE.match(line)
+                    or MARKDOWN_RULE.match(line) or MARKDOWN_HTML.match(line)
+                    or item and item.group(4) and item.group(3) in (None, '1'))
+
+    def convert_blocks(self, lines):
+        blocks = []
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+            if not line.strip():
+                i += 1
+                continue
+
+            fence = MARKDOWN_FENCE.match(line)
+            if fence:
+                marker = fence.group(1)
+                code = []
+                i += 1
+                while i < len(lines) and not (lines[i].strip().startswith(marker)
+                                              and not lines[i].strip().strip(marker[0])):
+                    code.append(lines[i])
+                    i += 1
+                i += 1
+                language = f' class="language-{html.escape(fence.group(2))}"' if fence.group(2) else ''
+                blocks.append(f"<pre><code{language}>{html.escape(chr(10).join(code) + chr(10), quote=False)}</code></pre>")
+                continue
+
+            if line.startswith('    '):
+                code = []
+                while i < len(lines) and (lines[i].startswith('    ') or not lines[i].strip()):
+                    code.append(lines[i][4:])
+                    i += 1
+                while not code[-1].strip():
+                    code.pop()
+                blocks.append(f"<pre><code>{html.escape(chr(10).join(code) + chr(10), quote=False)}</code></pre>")
+                continue
+
+            heading = MARKDOWN_HEADING.match(line)
+            if heading:
+                level = len(heading.group(1))
+                blocks.append(f"<h{level}>{self.convert_inline(heading.group(2) or '')}</h{level}>")
+                i += 1
+                continue
+
+            if MARKDOWN_RULE.match(line):
+                blocks.append('<div><hr></div>')
+                i += 1
+                continue
+
+            if MARKDOWN_QUOTE.match(line):
+                quoted = []
+                while i < len(lines) and lines[i].strip():
+                    quote = MARKDOWN_QUOTE.match(lines[i])
+                    quoted.append(lines[i][quote.end():] if quote else lines[i])
+                    i += 1
+                    # A blank line between two quoted lines stays in the quote
+                    if (i + 1 < len(lines) and not lines[i].strip()
+                            and MARKDOWN_QUOTE.match(lines[i + 1]) and quoted[-1].strip()):
+                        quoted.append('')
+                        i += 1
+                blocks.append(f"<blockquote>{''.join(self.convert_blocks(quoted))}</blockquote>")
+                continue
+
+            item = MARKDOWN_ITEM.match(line)
+            if item:
+                i = self.convert_list(lines, i, blocks)
+                continue
+
+            if MARKDOWN_HTML.match(line):
+                raw = []
+                while i < len(lines) and lines[i].strip():
+                    raw.append(lines[i])
+                    i += 1
+                blocks.append('\n'.join(raw))
+                continue
+
+            paragraph = [line]
+            i += 1
+            level = None
+            while i < len(lines) and lines[i].strip():
+                setext = MARKDOWN_SETEXT.match(lines[i])
+                if setext:
+                    level = 1 if setext.group(1)[0] == '=' else 2
+                    i += 1
+                    break
+                if self.starts_block(lines[i]):
+                    break
+                paragraph.append(lines[i])
+                i += 1
+            text = '\n'.join(part.lstrip() for part in paragraph).rstrip()
+            if level:
+                blocks.append(f"<h{level}>{self.convert_inline(text)}</h{level}>")
+            else:
+                blocks.append(self.convert_paragraph(text))
+        return blocks
+
+    def convert_list(self, lines, i, blocks):
+        # One list: items share a kind of marker, and an item's own lines
+        # are indented past its marker
+        first = MARKDOWN_ITEM.match(lines[i])
+        ordered = first.group(3) is not None
+        marker = first.group(2)[-1]
+        items = []
+        while i < len(lines):
+            item = MARKDOWN_ITEM.match(lines[i])
+            if not item or (item.group(3) is not None) != ordered or item.group(2)[-1] != marker:
+                break
+            indent = item.end() if item.group(4) else len(item.group(1)) + len(item.group(2)) + 1
+            body = [lines[i][item.end():]]
+            i += 1
+            while i < len(lines):
+                line = lines[i]
+                if not line.strip():
+                    # A blank line only continues the item if more of it follows
+                    if i + 1 < len(lines) and lines[i + 1].startswith(' ' * indent) and lines[i + 1].strip():
+                        body.append('')
+                        i += 1
+                        continue
+                    break
+                if line.startswith(' ' * indent):
+                    body.append(line[indent:])
+                elif not MARKDOWN_ITEM.match(line) and not self.starts_block(line) and body[-1].strip():
+                    # A lazy continuation of the item's paragraph
+                    body.append(line.strip())
+                else:
+                    break
+                i += 1
+            items.append(body)
+            # A blank line between items
+            if (i + 1 < len(lines) and not lines[i].strip() and MARKDOWN_ITEM.match(lines[i + 1])
+                    and (MARKDOWN_ITEM.match(lines[i + 1]).group(3) is not None) == ordered):
+                i += 1
+        tag = 'ol' if ordered else 'ul'
+        start = int(first.group(3)) if ordered else 1
+        attrs = f' start="{start}"' if start != 1 else ''
+        blocks.append(f"<{tag}{attrs}>" + ''.join(f"<li>{''.join(self.convert_blocks(body))}</li>" for body in items)
+                      + f"</{tag}>")
+        return i
+
+    def convert_paragraph(self, text):
+        # An image alone in its paragraph is a figure, captioned with its title
+        image = MARKDOWN_IMAGE.fullmatch(text)
+        if image:
+            src, title = self.destination(image.group(2), image.group(3), image.group(4), image.group(1))
+            if src is not None:
+                caption = f'<figcaption class="image-caption">{self.convert_inline(title)}</figcaption>' if title else ''
+                return (f'<div class="captioned-image-container"><figure>'
+                        f'<img src="{html.escape(src)}" alt="{html.escape(self.plain(html.escape(image.group(1), quote=False)))}">'
+                        f'{caption}</figure></div>')
+        return f"<p>{self.convert_inline(text)}</p>"
+
+    def destination(self, url, title, label, text):
+        # The URL and title of an inline link, or a reference link's
+        if url is not None:
+            return url.strip('<>'), title[1:-1] if title else None
+        return self.references.get((label or text).lower(), (None, None))
+
+    def plain(self, text):
+        # Alt text: the words without any markup
+        for pattern, replacement in MARKDOWN_EMPHASIS:
+            text = pattern.sub(r'\1', text)
+        return html_text(text)
+
+    def convert_inline(self, text):
+        pieces = []
+
+        def protect(piece):
+            pieces.append(piece)
+            return f'\x00{len(pieces) - 1}\x00'
+
+        def protected(m):
+            if m.group('code') is not None:
+                code = m.group(3)
+                if code.startswith(' ') and code.endswith(' ') and code.strip():
+                    code = code[1:-1]
+                return protect(f"<code>{html.escape(code.replace(chr(10), ' '), quote=False)}</code>")
+            if m.group('br') is not None:
+                return protect('<br>') + '\n'
+            if m.group('escape') is not None:
+                return protect(html.escape(m.group('escape'), quote=False))
+            if m.group('autolink') is not None:
+                target = m.group('autolink')
+                href = target if '://' in target else f"mailto:{target}"
+                return protect(f'<a href="{html.escape(href)}">{html.escape(target, quote=False)}</a>')
+            return protect(m.group('html'))
+
+        def restore(fragment):
+            return MARKDOWN_PLACEHOLDER.sub(lambda m: pieces[int(m.group(1))], fragment)
+
+        def attribute(value):
+            # Link targets were escaped along with the text around them
+            return html.escape(html.unescape(restore(value)))
+
+        def footnote(m):
+            label = m.group(1)
+            if label not in self.footnotes:
+                return m.group()
+            first = label not in self.order
+            if first:
+                self.order.append(label)
+            number = self.order.index(label) + 1
+            anchor = f' id="footnote-anchor-{number}"' if first else ''
+            return protect(f'<a class="footnote-anchor"{anchor} href="#footnote-{number}" target="_self">{number}</a>')
+
+        def image(m):
+            src, title = self.destination(m.group(2), m.group(3), m.group(4), m.group(1))
+            if src is None:
+                return m.group()
+            title = f' title="{attribute(title)}"' if title else ''
+            return protect(f'<img src="{attribute(src)}" alt="{html.escape(self.plain(restore(m.group(1))))}"{title}>')
+
+        def link(m):
+            if m.group(2) is None and m.group(4) is None and m.group(1).lower() not in self.references:
+                return m.group()
+            href, title = self.destination(m.group(2), m.group(3), m.group(4), m.group(1))
+            if href is None:
+                return m.group()
+            title = f' title="{attribute(title)}"' if title else ''
+            return protect(f'<a href="{attribute(href)}"{title}>') + m.group(1) + protect('</a>')
+
+        text = MARKDOWN_PROTECTED.sub(protected, text)
+        text = html.escape(text, quote=False)
+        text = re.sub(r'\[\^([^\]\s]+)\]', footnote, text)
+        text = MARKDOWN_IMAGE.sub(image, text)
+        text = MARKDOWN_LINK.sub(link, text)
+        for pattern, replacement in MARKDOWN_EMPHASIS:
+            text = pattern.sub(replacement, text)
+        return restore(text)
+
+
+def convert_markdown(text):
+    return MarkdownConverter(text).html()
+
+
+def markdown_content(job):
+    """The HTML for a Markdown post, converted once per version of its source.
+
+    Pages are re-rendered for more reasons than an edit (a new neighbour,
+    different options), and those renders read the conversion back from
+    .build-cache/markdown/ instead of doing it again. The source is hashed
+    here rather than trusting the job's hash, which `serve --watch` keeps
+    from before an edit.
+    """
+    cache_path = markdown_cache_dir / f"{markdown_key(sha256_file(job['source_path']))}.html"
+    try:
+        return read_source(cache_path)
+    except FileNotFoundError:
+        pass
+    content = convert_markdown(read_source(job['source_path']))
+    if job['output_path'] is not None:
+        write_cache(cache_path, content)
+    return content
+
+
+def markdown_key(source_hash):
+    return sha256(f"{MARKDOWN_VERSION}:{source_hash}")[:32]
+
+
+def minify_outside_kept(text, minify):
+    # Apply `minify` to all of `text` but the inside of MINIFY_KEEP elements
+    pieces = []
+    at = 0
+    for m in MINIFY_KEEP.finditer(text):
+        pieces.append(minify(text[at:m.start(3)]))
+        pieces.append(m.group(3))
+        at = m.end(3)
+    pieces.append(minify(text[at:]))
+    return ''.join(pieces)
+
+
+def minify_tag(match):
+    def attribute(m):
+        name = m.group(1).lower()
+        if name.startswith('data-') or (name, m.group(2)) in MINIFY_DEFAULTS:
+            return ''
+        return m.group()
+    return match.group(1) + MINIFY_ATTRIBUTE.sub(attribute, match.group(2))
+
+
+def minify_markup(text):
+    def cdn_source(m):
+        # The <img> alone gets the same images
+        return '' if m.group(1).replace(',f_webp,', ',f_auto,') == m.group(2) else m.group()
+
+    text = MINIFY_CDN_SOURCE.sub(cdn_source, text)
+    text = MINIFY_TAG.sub(minify_tag, text)
+    # Emptying one wrapper can leave the one around it empty
+    count = 1
+    while count:
+        text, count = MINIFY_EMPTY.subn('', text)
+    return text
+
+
+def minify_whitespace(text):
+    text = MINIFY_COMMENT.sub('', text)
+    # Keep a line break where there was one; it costs the same as a space
+    text = MINIFY_SPACE.sub(lambda m: '\n' if '\n' in m.group() else ' ', text)
+    return MINIFY_BLOCK.sub(r'\1', text)
+
+
+def minify_content(content):
+    """--minify's pass over a cleaned post, before it goes in the template.
+
+    Drops the bare wrappers Substack leaves empty (never an empty <p>, which
+    is a blank line in the post), attributes nothing on the site reads and
+    <source> elements that repeat their image's CDN srcset. The inside of a
+    <pre> is left exactly as it is.
+    """
+    return minify_outside_kept(content, minify_markup)
+
+
+def minify_page(page):
+    """--minify's pass over a filled page: collapse the whitespace.
+
+    The template's indentation goes, along with every run of whitespace
+    next to a block-level tag, where it never shows. The inside of <pre>,
+    <textarea>, <script> and <style> is kept byte for byte, so a poem keeps
+    its layout.
+    """
+    return minify_outside_kept(page, minify_whitespace)
+
+
+def html_text(fragment):
+    # The words of a piece of HTML, as search and summaries see them. Tags
+    # count as spaces, so a block's words never run into the next block's.
+    return ' '.join(html.unescape(SEARCH_TAG.sub(' ', fragment)).split())
+
+
+def block_type(tag):
+    classes = CONTENT_CLASS.search(tag)
+    if classes and classes.group(1).split()[:1]:
+        kind = CONTENT_CLASSES.get(classes.group(1).split()[0])
+        if kind:
+            return kind
+    name = CONTENT_TAG.match(tag).group(2).lower()
+    return CONTENT_TAGS.get(name, 'html')
+
+
+def parse_content(content):
+    """Parse a cleaned post into its block model.
+
+    The model lists the post's top-level blocks (paragraphs, headings,
+    <pre> poems, quotes, lists, images, footnotes, rules), each with its
+    exact HTML and its text, along with the post's images, links, footnotes
+    and word count. Joining the blocks' HTML gives back the post byte for
+    byte, so the page, the feeds and the search index are all made from
+    the model. A build caches it in .build-cache/content/, so a post is only
+    parsed again when it changes.
+
+    Text outside any element is a 'text' block, and whitespace between
+    blocks belongs to the block after it.
+    """
+    ranges = []
+    stack = []
+    start = 0
+    kind = None
+    for m in CONTENT_TAG.finditer(content):
+        name = m.group(2)
+        if name is None:
+            # A comment
             continue
-
-        # Extract info
-        post_id = row['post_id']
-        slug = post_id.split('.')[1] if '.' in post_id else None
-        if not slug:
+        name = name.lower()
+        if m.group(1):
+            # Close whatever is still open inside this element too; a close
+            # tag for an element that isn't open is ignored
+            if name in stack:
+                while stack.pop() != name:
+                    pass
+                if not stack:
+                    ranges.append((kind, start, m.end()))
+                    start = m.end()
             continue
-
-        title = row['title'].strip('"')
-        date_str = row['post_date']
-
-        # Format date
+        if not stack:
+            if content[start:m.start()].strip(' \t\n\r\f'):
+                ranges.append(('text', start, m.start()))
+                start = m.start()
+            kind = block_type(m.group())
+        if name not in CONTENT_VOID and not m.group().endswith('/>'):
+            stack.append(name)
+        elif not stack:
+            ranges.append((kind, start, m.end()))
+            start = m.end()
+    if start < len(content):
+        if stack:
+            # An element that never closes runs to the end
+            ranges.append((kind, start, len(content)))
+        elif ranges and not content[start:].strip(' \t\n\r\f'):
+            ranges[-1] = (ranges[-1][0], ranges[-1][1], len(content))
+        else:
+            ranges.append(('text', start, len(content)))
+
+    blocks = []
+    images = []
+    footnotes = []
+    for kind, begin, end in ranges:
+        fragment = content[begin:end]
+        if kind == 'html' and CONTENT_RULE.fullmatch(fragment.strip()):
+            kind = 'rule'
+        blocks.append({'type': kind, 'html': fragment, 'text': html_text(fragment)})
+
+        if '<img' in fragment:
+            caption = CONTENT_CAPTION.search(fragment) if kind == 'image' else None
+            for img in CONTENT_IMG.finditer(fragment):
+                attrs = dict(re.findall(r'([\w-]+)="([^"]*)"', img.group()))
+                images.append({
+                    'src': html.unescape(attrs.get('src', '')),
+                    'alt': html.unescape(attrs.get('alt', '')),
+                    'caption': html_text(caption.group(1)) if caption else '',
+                })
+        if kind == 'footnote':
+            number = CONTENT_FOOTNOTE.search(fragment)
+            if number:
+                footnotes.append({'number': html_text(number.group(1)),
+                                  'text': html_text(fragment[number.end():])})
+
+    return {
+        'blocks': blocks,
+        'images': images,
+        # Links out of the post; footnote links stay within the page
+        'links': [html.unescape(href) for href in CONTENT_LINK.findall(content) if not href.startswith('#')],
+        'footnotes': footnotes,
+        'words': sum(len(block['text'].split()) for block in blocks),
+    }
+
+
+def content_html(model):
+    # The post's HTML, exactly as it was parsed
+    return ''.join(block['html'] for block in model['blocks'])
+
+
+def load_model(slug):
+    with open(content_cache_dir / f"{slug}.json", 'r') as f:
+        return json.load(f)
+
+
+def write_cache(path, text):
+    # Cache files are written by worker processes, so each stages its own
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    tmp_path.replace(path)
+
+
+class Template:
+    """A page template from templates/, compiled once into chunks and slots.
+
+    `{{ name }}` is a slot for a value. A slot alone on its line takes a
+    block of text such as a post's content: every line of it is indented to
+    the slot's column, and lines of nothing but whitespace are left empty.
+    `{% include "file" %}` pastes in a partial, and a template starting with
+    `{% extends "file" %}` fills the parent's `{% block name %}` sections with
+    its own. A line holding only a `{% %}` tag leaves nothing in the output.
+    Nothing else is special, so CSS and scripts are written as they are.
+
+    Rendering joins the prebuilt byte chunks with the encoded values.
+    """
+
+    TOKEN = re.compile(
+        r'^[ \t]*\{%\s*(?P<line_tag>\w+)(?:\s+"?(?P<line_arg>[\w.-]+)"?)?\s*%\}[ \t]*\n'
+        r'|^(?P<indent>[ \t]*)\{\{\s*(?P<block_slot>\w+)\s*\}\}[ \t]*$'
+        r'|\{\{\s*(?P<slot>\w+)\s*\}\}'
+        r'|\{%\s*(?P<tag>\w+)(?:\s+"?(?P<arg>[\w.-]+)"?)?\s*%\}',
+        re.MULTILINE)
+
+    # Matches at the start of every line of a block value: empty for a line
+    # with something on it, or the whole line if it is only whitespace
+    LINE_START = re.compile(r'^(?:(?=[^\n]*\S)|[^\S\n]+$)', re.MULTILINE)
+
+    def __init__(self, name):
+        self.name = name
+        self.sources = {}
+        nodes, parent = self.parse(name)
+        blocks = {}
+        while parent is not None:
+            # The most derived template's version of a block wins
+            self.collect_blocks(nodes, blocks)
+            nodes, parent = self.parse(parent)
+
+        self.segments = []
+        for segment in self.flatten(nodes, blocks):
+            if isinstance(segment, str) and self.segments and isinstance(self.segments[-1], str):
+                self.segments[-1] += segment
+            else:
+                self.segments.append(segment)
+        self.segments = [s.encode('utf-8') if isinstance(s, str) else s for s in self.segments]
+        self.hash = sha256(json.dumps(self.sources, sort_keys=True))
+
+    def parse(self, name):
+        # Returns the template's nodes and the name of the template it extends
+        source = (templates_dir / name).read_text()
+        self.sources[name] = source
+        root = []
+        stack = [root]
+        parent = None
+        at = 0
+        for m in self.TOKEN.finditer(source):
+            if m.start() > at:
+                stack[-1].append(source[at:m.start()])
+            at = m.end()
+            if m['block_slot']:
+                stack[-1].append(('slot', m['block_slot'], m['indent']))
+                continue
+            if m['slot']:
+                stack[-1].append(('slot', m['slot'], None))
+                continue
+            tag = m['line_tag'] or m['tag']
+            arg = m['line_arg'] or m['arg']
+            if tag == 'extends':
+                parent = arg
+            elif tag == 'include':
+                nodes, _ = self.parse(arg)
+                stack[-1].extend(nodes)
+            elif tag == 'block':
+                block = ('block', arg, [])
+                stack[-1].append(block)
+                stack.append(block[2])
+            elif tag == 'endblock' and len(stack) > 1:
+                stack.pop()
+            else:
+                raise ValueError(f"{name}: unexpected {m.group().strip()}")
+        if len(stack) > 1:
+            raise ValueError(f"{name}: unclosed block")
+        if at < len(source):
+            root.append(source[at:])
+        return root, parent
+
+    def collect_blocks(self, nodes, blocks):
+        for node in nodes:
+            if isinstance(node, tuple) and node[0] == 'block':
+                blocks.setdefault(node[1], node[2])
+                self.collect_blocks(node[2], blocks)
+
+    def flatten(self, nodes, blocks):
+        for node in nodes:
+            if isinstance(node, str):
+                yield node
+            elif node[0] == 'block':
+                yield from self.flatten(blocks.get(node[1], node[2]), blocks)
+            else:
+                yield node[1], None if node[2] is None else node[2].encode('utf-8')
+
+    def render(self, values):
+        chunks = []
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                chunks.append(segment)
+                continue
+            name, indent = segment
+            value = values[name]
+            if indent is None:
+                chunks.append(value.encode('utf-8'))
+            elif '\n' not in value:
+                # Exports are mostly one long line: no need to copy it to indent it
+                if value and not value.isspace():
+                    chunks.append(indent)
+                    chunks.append(value.encode('utf-8'))
+            else:
+                prefix = indent.decode('utf-8')
+                value = self.LINE_START.sub(lambda m: '' if m.group() else prefix, value)
+                chunks.append(value.encode('utf-8'))
+        return b''.join(chunks)
+
+
+templates = {}
+
+
+def load_template(name):
+    # Compiled once per process, and per site
+    key = (templates_dir, name)
+    if key not in templates:
+        templates[key] = Template(name)
+    return templates[key]
+
+
+generator_hash = sha256(Path(__file__).read_bytes())
+
+
+def original_image_url(src):
+    # substackcdn.com fetch URLs carry the original, URL-encoded, at the end
+    if src.startswith(SUBSTACK_CDN):
+        src = urllib.parse.unquote(src[src.rindex('/http') + 1:])
+    if src.startswith(SUBSTACK_IMAGES):
+        return src
+    return None
+
+
+def load_original_image(url, settings):
+    """Return the bytes of a Substack original, or None if it can't be found.
+
+    Looks in the local source directory first, then in the download cache,
+    and only then fetches it from the image origin (Substack's S3 bucket
+    unless a stand-in is configured).
+    """
+    name = url.rsplit('/', 1)[1]
+    if settings['source']:
+        local_path = Path(settings['source']) / name
+        if local_path.exists():
+            return local_path.read_bytes()
+
+    cached_path = image_cache_dir / "originals" / name
+    if cached_path.exists():
+        return cached_path.read_bytes()
+
+    origin = settings['origin'] or SUBSTACK_IMAGES
+    try:
+        with urllib.request.urlopen(origin.rstrip('/') + '/' + url[len(SUBSTACK_IMAGES):], timeout=30) as response:
+            data = response.read()
+    except (OSError, ValueError) as e:
+        print(f"Warning: could not fetch {url}: {e}")
+        return None
+
+    cached_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cached_path.with_name(f"{name}.{os.getpid()}.tmp")
+    tmp_path.write_bytes(data)
+    tmp_path.replace(cached_path)
+    return data
+
+
+def image_variants(data):
+    """Encode the resized variants of one image into images/.
+
+    Variants are named after a hash of the original, and a small record of
+    what was encoded is kept in the cache, so an image that has been seen
+    before is never decoded or encoded again.
+    """
+    key = sha256(data)[:16]
+    record_path = image_cache_dir / f"{key}.json"
+    if record_path.exists():
+        with open(record_path, 'r') as f:
+            record = json.load(f)
+        if all((images_dir / name).exists() for names in record['variants'].values() for name, _, _ in names):
+            return record
+
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+    width, height = image.size
+
+    # Never upscale: an image narrower than a width gets a copy at its own size
+    widths = [w for w in IMAGE_WIDTHS if w < width] + ([width] if width <= IMAGE_WIDTHS[-1] else [])
+    formats = [fmt for fmt in IMAGE_FORMATS if features.check(fmt)]
+    images_dir.mkdir(exist_ok=True)
+    record = {'variants': {}}
+    for w in widths:
+        h = round(height * w / width)
+        resized = image if w == width else image.resize((w, h), Image.LANCZOS)
+        for fmt in formats:
+            name = f"{key}-{w}.{fmt}"
+            record['variants'].setdefault(fmt, []).append([name, w, h])
+            out_path = images_dir / name
+            if out_path.exists():
+                continue
+            tmp_path = out_path.with_name(f"{name}.{os.getpid()}.tmp")
+            resized.save(tmp_path, format=fmt.upper(), **IMAGE_FORMATS[fmt])
+            tmp_path.replace(out_path)
+
+    record_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = record_path.with_name(f"{key}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(record, f)
+    tmp_path.replace(record_path)
+    return record
+
+
+def mirror_images(content, settings):
+    """Point a post's Substack images at local, resized variants.
+
+    Each <picture> (or bare <img>) showing a Substack image becomes a
+    <picture> with a srcset per format and explicit dimensions. Images that
+    can't be loaded keep their CDN markup, and links to a full-size original
+    are pointed at the largest local variant. Returns the new content and
+    how many images were left on the CDN.
+    """
+    missing = 0
+    mirrored = {}
+
+    def replace(match):
+        nonlocal missing
+        img = re.search(r'<img\b[^>]*>', match.group())
+        attrs = dict(re.findall(r'([\w-]+)="([^"]*)"', img.group())) if img else {}
+        url = original_image_url(html.unescape(attrs.get('src', '')))
+        if url is None:
+            return match.group()
+
+        data = load_original_image(url, settings)
+        if data is None:
+            missing += 1
+            return match.group()
+        variants = image_variants(data)['variants']
+
+        def srcset(fmt):
+            return ', '.join(f"../images/{name} {w}w" for name, w, _ in variants[fmt])
+
+        fallback = 'webp' if 'webp' in variants else next(iter(variants))
+        largest, width, height = variants[fallback][-1]
+        mirrored[url] = largest
+        sources = ''.join(f'<source type="image/{fmt}" srcset="{srcset(fmt)}" sizes="{IMAGE_SIZES}">'
+                          for fmt in variants if fmt != fallback)
+        alt = attrs.get('alt', '')
+        title = f' title="{attrs["title"]}"' if attrs.get('title') else ''
+        return (f'<picture>{sources}<img src="../images/{largest}" srcset="{srcset(fallback)}" '
+                f'sizes="{IMAGE_SIZES}" width="{width}" height="{height}" alt="{alt}"{title} '
+                f'loading="lazy"></picture>')
+
+    def relink(match):
+        url = original_image_url(html.unescape(match.group(1)))
+        return f'href="../images/{mirrored[url]}"' if url in mirrored else match.group()
+
+    content = re.sub(r'<picture\b[^>]*>.*?</picture>|<img\b[^>]*>', replace, content, flags=re.DOTALL)
+    if mirrored:
+        content = re.sub(r'href="(https://[^"]*)"', relink, content)
+    return content, missing
+
+
+class Word(str):
+    """One word of the command line.
+
+    Equal words stay separate objects, so the word argparse took as the
+    command can be told apart from the same word given as an option's value.
+    """
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate post pages from the Substack export.")
+    parser.add_argument('command', nargs='?',
+                        choices=('build', 'preview', 'serve', 'check', 'daemon', 'rebuild', 'bench'),
+                        default='build',
+                        help="build the site (default), render every post including drafts and scheduled "
+                             "ones into preview/, serve the site locally, rendering pages on request, "
+                             "check its links and assets, stay running as a daemon that builds on request "
+                             "and when a scheduled post goes live, "
+                             "ask that daemon for a build (or build here if none is running), "
+                             "or run bench-posts.py (bench takes its own options)")
+    parser.add_argument('--site', type=Path, default=DEFAULT_SITE, metavar='DIR',
+                        help="the site to build into (default: %(default)s)")
+    parser.add_argument('--csv', type=Path, default=DEFAULT_CSV, metavar='FILE',
+                        help="the export's posts.csv (default: %(default)s)")
+    parser.add_argument('--sources', type=Path, default=DEFAULT_SOURCES, metavar='DIR',
+                        help="the exported posts, <post_id>.html or Markdown (default: %(default)s)")
+    parser.add_argument('--config', type=Path, metavar='FILE',
+                        help=f"read settings from this JSON file (default: {CONFIG_NAME} in the site, if any)")
+    parser.add_argument('--force', action=argparse.BooleanOptionalAction, default=False,
+                        help="re-render every post, ignoring the build manifest")
+    parser.add_argument('--index-by-year', action=argparse.BooleanOptionalAction, default=False,
+                        help="group the writing index under a heading per year")
+    parser.add_argument('--mirror-images', action=argparse.BooleanOptionalAction, default=False,
+                        help="serve post images from resized local copies instead of Substack's CDN "
+                             "(needs Pillow)")
+    parser.add_argument('--image-source', metavar='DIR',
+                        help="directory of original images to use before downloading them")
+    parser.add_argument('--image-origin', metavar='URL',
+                        help=f"fetch originals from URL instead of {SUBSTACK_IMAGES}")
+    parser.add_argument('--jobs', '-j', type=int, default=1, metavar='N',
+                        help="render posts in N worker processes (0 = one per CPU)")
+    parser.add_argument('--precompress', action=argparse.BooleanOptionalAction, default=False,
+                        help="keep .gz and .br copies of the pages, assets and shared scripts for the "
+                             "server to send as they are (.br needs the brotli package)")
+    parser.add_argument('--search', action=argparse.BooleanOptionalAction, default=None,
+                        help="update the search index in search/ (default: on)")
+    parser.add_argument('--feed-posts', type=int, default=20, metavar='N',
+                        help="how many of the newest posts feed.xml and rss.xml carry "
+                             "(0 = all; default: %(default)s)")
+    parser.add_argument('--feed-summary', action=argparse.BooleanOptionalAction, default=False,
+                        help="give each feed entry the start of the post instead of all of it")
+    parser.add_argument('--minify', action=argparse.BooleanOptionalAction, default=False,
+                        help="collapse whitespace (outside <pre>) and drop Substack's empty wrappers and "
+                             "unused attributes from post pages, reporting the bytes saved per page")
+    parser.add_argument('--check', action=argparse.BooleanOptionalAction, default=False,
+                        help="check the site's links and assets after building, as the check command does")
+    parser.add_argument('--cleanup-stats', action=argparse.BooleanOptionalAction, default=False,
+                        help="report matches and time spent per cleanup rule")
+    parser.add_argument('--verify-cleanup', action=argparse.BooleanOptionalAction, default=False,
+                        help="check the single-pass cleanup against the rule-by-rule passes "
+                             "for every rendered post (use with --force to check all)")
+    parser.add_argument('--profile', nargs='?', const=True, type=Path, metavar='FILE',
+                        help="write a JSON trace of time and bytes per post, stage and cleanup rule "
+                             "(default FILE: .build-cache/profile.json in the site; use with --force "
+                             "to profile all)")
+    parser.add_argument('--profile-top', type=int, default=10, metavar='N',
+                        help="how many of the slowest posts and rules to list (default: %(default)s)")
+    parser.add_argument('--watch', action=argparse.BooleanOptionalAction, default=False,
+                        help="with serve: re-render pages when their sources change and reload open browsers")
+    parser.add_argument('--trigger', type=Path, metavar='FILE',
+                        help="with daemon: build whenever FILE is touched (default: .build-cache/rebuild "
+                             "in the site)")
+    parser.add_argument('--port', type=int, default=8000,
+                        help="port for serve (default: %(default)s)")
+    parser.add_argument('--bind', default='127.0.0.1', metavar='ADDRESS',
+                        help="address for serve to listen on (default: %(default)s)")
+    parser.add_argument('--cprofile', type=Path, metavar='FILE',
+                        help="also save a cProfile dump of the build to FILE, for snakeviz or "
+                             "flameprof; renders in this process so the profile sees every post")
+    args = parser.parse_args(argv)
+
+    # Settings from the config file become the defaults, and the command
+    # line is parsed again over them
+    config_path = args.config or args.site / CONFIG_NAME
+    if args.config is not None or config_path.exists():
         try:
-            dt = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-            formatted_date = dt.strftime('%B %d, %Y')
-        except:
-            formatted_date = date_str
-
-        # Find the HTML file
-        html_path = html_dir / f"{post_id}.html"
-        if not html_path.exists():
-            print(f"Warning: {html_path} not found")
-            continue
+            with open(config_path, 'r') as f:
+                config = json.load(f)
+        except (OSError, ValueError) as e:
+            raise SystemExit(f"Can't read {config_path}: {e}")
+        if not isinstance(config, dict):
+            raise SystemExit(f"{config_path} should hold a JSON object of settings")
+        settings = {}
+        for key, value in config.items():
+            name = key.replace('-', '_')
+            # Older configs turned search off with "no-search"
+            if name == 'no_search' and isinstance(value, bool):
+                name, value = 'search', not value
+            if name not in vars(args) or name in ('command', 'config'):
+                raise SystemExit(f"{config_path}: unknown setting {key!r}")
+            if name in CONFIG_PATHS and isinstance(value, str):
+                value = str(config_path.parent / Path(value).expanduser())
+            settings[name] = value
+        parser.set_defaults(**settings)
+        args = parser.parse_args(argv)
+
+    # On unless the command line or the config turned it off
+    if args.search is None:
+        args.search = True
+    return args
+
+
+def load_manifest(force, template_hash, path=None):
+    # Load the manifest from the previous build (or preview, given its
+    # `path`). Anything that changes the output of every page (the
+    # template, the shared assets it links to or this script) invalidates
+    # all of it.
+    path = path or manifest_path
+    manifest = {}
+    if path.exists() and not force:
+        try:
+            with open(path, 'r') as mf:
+                manifest = json.load(mf)
+        except (OSError, ValueError):
+            print(f"Warning: ignoring unreadable manifest {path}")
+    if (manifest.get('version') != MANIFEST_VERSION
+            or manifest.get('template') != template_hash
+            or manifest.get('generator') != generator_hash):
+        manifest = {}
+    return manifest
+
+
+def save_manifest(entries, template_hash, path=None, **hashes):
+    # `hashes` are the inputs of the site-wide outputs: the index, the
+    # search index and the feeds. Returns the manifest.
+    path = path or manifest_path
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'template': template_hash,
+        'generator': generator_hash,
+        'posts': entries,
+        **hashes,
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    write_output(path, json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8'))
+    return manifest
+
+
+def file_stamp(path):
+    # What a file's stat says about its content, or None if it's missing
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def sha256_file(path):
+    # Hash in chunks so a huge export (inline base64 images) is never held whole
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def asset_sources():
+    # Each template placeholder and the file it publishes
+    return ([(key, templates_dir / name) for key, name in POST_ASSETS.items()]
+            + [(key, site_dir / name) for key, name in PAGE_SCRIPTS.items()])
+
+
+def publish_assets():
+    """Write the fingerprinted copies of POST_ASSETS and PAGE_SCRIPTS into assets/.
+
+    Returns the published file name for each template placeholder. Copies
+    left over from older versions of an asset are removed.
+    """
+    assets_dir.mkdir(exist_ok=True)
+    published = {}
+    for key, source in asset_sources():
+        data = source.read_bytes()
+        stem, suffix = source.name.rsplit('.', 1)
+        fingerprinted = f"{stem}.{sha256(data)[:10]}.{suffix}"
+        published[key] = fingerprinted
+
+        asset_path = assets_dir / fingerprinted
+        if not asset_path.exists():
+            tmp_path = asset_path.with_name(asset_path.name + '.tmp')
+            tmp_path.write_bytes(data)
+            tmp_path.replace(asset_path)
+            print(f"Created: {asset_path}")
+
+        for old_path in assets_dir.glob(f"{stem}.*.{suffix}"):
+            if old_path.name != fingerprinted and re.fullmatch(r'[0-9a-f]{10}', old_path.name[len(stem) + 1:-len(suffix) - 1]):
+                old_path.unlink()
+                print(f"Removed: {old_path}")
+    return published
+
+
+def read_rows():
+    with open(csv_path, 'r') as f:
+        return list(csv.DictReader(f))
+
+
+def parse_post_date(date_str):
+    """Read a post_date, or return None if it's empty or malformed.
+
+    Substack writes UTC times like 2023-06-05T02:00:00.000Z. A date or time
+    without a zone is taken as UTC too, so every parsed date can be compared
+    with every other.
+    """
+    try:
+        dt = datetime.fromisoformat(date_str.strip().replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+def publish_status(row, date_obj, now):
+    # 'draft' until it's published on Substack, then 'scheduled' until its
+    # date comes, then 'published'
+    if row['is_published'] != 'true':
+        return 'draft'
+    if date_obj is not None and date_obj > now:
+        return 'scheduled'
+    return 'published'
+
+
+def scan_posts(old_entries, rows=None, known=None, drafts=False):
+    """First phase of a build: a metadata-only pass over posts.csv.
+
+    Yields the slug, title, dates, source location and publish status of
+    every published or scheduled post, and of drafts too with `drafts`.
+    Post bodies are never loaded here; render_page reads, cleans, writes
+    and drops them one at a time.
+
+    The daemon passes the rows of posts.csv it has already parsed, and the
+    posts it scanned last time by slug: a post whose row and source file
+    haven't changed is yielded again as it was.
+    """
+    now = datetime.now(timezone.utc)
+    with contextlib.ExitStack() as stack:
+        if rows is None:
+            rows = csv.DictReader(stack.enter_context(open(csv_path, 'r')))
+        for row in rows:
+            if row['is_published'] != 'true' and not drafts:
+                continue
+
+            # Extract info
+            post_id = row['post_id']
+            slug = post_id.split('.')[1] if '.' in post_id else None
+            if not slug:
+                continue
+
+            # A scheduled post is looked at afresh until it goes live
+            previous = known.get(slug) if known else None
+            if previous is not None and previous['row'] == row and previous['status'] != 'scheduled':
+                try:
+                    stat = previous['source_path'].stat()
+                except OSError:
+                    stat = None
+                # An export that appears takes over from a Markdown file
+                if (stat is not None and [stat.st_mtime_ns, stat.st_size] == previous['source_stat']
+                        and not (previous['markdown'] and (html_dir / f"{post_id}.html").exists())):
+                    yield previous
+                    continue
+
+            title = row['title'].strip('"')
+            date_str = row['post_date']
+
+            # Parse the date once; a post whose date can't be read is listed
+            # as undated, showing the date as written
+            date_obj = parse_post_date(date_str)
+            if date_obj is None and date_str.strip():
+                print(f"Warning: can't read post_date {date_str!r} of {post_id}; listing it as undated")
+            formatted_date = date_obj.strftime('%B %d, %Y') if date_obj else date_str
+
+            # Find the source: the Substack export, or else a Markdown file
+            html_path = html_dir / f"{post_id}.html"
+            source_path = next((path for path in (html_path, html_dir / f"{post_id}.md", html_dir / f"{slug}.md")
+                                if path.exists()), None)
+            if source_path is None:
+                print(f"Warning: {html_path} not found")
+                continue
+            markdown = source_path.suffix == '.md'
+
+            # Hash the source, trusting the previous hash if the file is untouched
+            stat = source_path.stat()
+            source_stat = [stat.st_mtime_ns, stat.st_size]
+            old_entry = old_entries.get(slug, {})
+            if old_entry.get('source_stat') == source_stat and bool(old_entry.get('markdown')) == markdown:
+                source_hash = old_entry['source']
+            else:
+                source_hash = sha256_file(source_path)
+
+            yield {
+                'post_id': post_id,
+                'slug': slug,
+                'title': title,
+                'date': formatted_date,
+                'source_path': source_path,
+                'markdown': markdown,
+                'source_stat': source_stat,
+                'source_hash': source_hash,
+                'row': row,
+                'row_hash': sha256(json.dumps(row, sort_keys=True)),
+                'date_obj': date_obj,
+                'status': publish_status(row, date_obj, now),
+            }
+
+
+def navigation(prev_post, next_post):
+    # Format navigation links
+    nav = {}
+    for side, post in (('prev', prev_post), ('next', next_post)):
+        if post:
+            nav[f'{side}_link'] = f"{post['slug']}.html"
+            nav[f'{side}_title'] = post['title']
+            nav[f'{side}_style'] = ""
+        else:
+            nav[f'{side}_link'] = "#"
+            nav[f'{side}_title'] = ""
+            nav[f'{side}_style'] = ' style="visibility: hidden;"'
+    return nav
 
-        # Read HTML content
-        with open(html_path, 'r') as hf:
-            content = hf.read()
-
-        # Clean up content: remove preformatted-block wrapper and class="text"
-        content = re.sub(
-            r'<div class="preformatted-block"[^>]*><label[^>]*>.*?</label><pre class="text">',
-            '<pre>',
-            content,
-            flags=re.DOTALL
-        )
-        content = content.replace('</pre></div>', '</pre>')
-        content = re.sub(r'<pre class="text">', '<pre>', content)
-
-        # Remove subscription prompts and buttons
-        content = re.sub(r'<p[^>]*>Thanks for reading.*?</p>', '', content, flags=re.DOTALL | re.IGNORECASE)
-        content = re.sub(r'<div[^>]*class="[^"]*subscription[^"]*"[^>]*>.*?</div>', '', content, flags=re.DOTALL | re.IGNORECASE)
-        content = re.sub(r'<button[^>]*subscribe[^>]*>.*?</button>', '', content, flags=re.DOTALL | re.IGNORECASE)
-        content = re.sub(r'<a[^>]*subscribe[^>]*>.*?</a>', '', content, flags=re.DOTALL | re.IGNORECASE)
-
-        # Remove Spotify embeds
-        content = re.sub(r'<iframe[^>]*spotify\.com[^>]*>.*?</iframe>', '', content, flags=re.DOTALL | re.IGNORECASE)
-        content = re.sub(r'<div[^>]*class="[^"]*spotify[^"]*"[^>]*>.*?</div>', '', content, flags=re.DOTALL | re.IGNORECASE)
-
-        # Remove image open buttons (Substack adds these)
-        content = re.sub(r'<button[^>]*>Open image.*?</button>', '', content, flags=re.DOTALL | re.IGNORECASE)
-        content = re.sub(r'<a[^>]*class="[^"]*image-link[^"]*"[^>]*>\s*<button[^>]*>.*?</button>\s*</a>', '', content, flags=re.DOTALL | re.IGNORECASE)
-        content = re.sub(r'<div[^>]*class="[^"]*image-button[^"]*"[^>]*>.*?</div>', '', content, flags=re.DOTALL | re.IGNORECASE)
-
-        # Fix "Another Arctic" formatting - add leading spaces to "I."
-        if slug == 'another-arctic':
-            content = content.replace('<pre>I.\n\n', '<pre>      I.\n\n')
-
-        posts.append({
-            'slug': slug,
-            'title': title,
-            'date': formatted_date,
-            'content': content,
-            'date_obj': datetime.fromisoformat(date_str.replace('Z', '+00:00')) if date_str else None
-        })
 
-# Sort posts by date (newest first)
-posts.sort(key=lambda p: p['date_obj'] if p['date_obj'] else datetime.min, reverse=True)
+def read_source(path):
+    with open(path, 'r') as hf:
+        return hf.read()
 
-# Generate HTML for each post with navigation
-for i, post in enumerate(posts):
-    # Determine prev/next posts
-    # "came right after" = newer (previous in the list)
-    # "came right before" = older (next in the list)
-    prev_post = posts[i-1] if i > 0 else None
-    next_post = posts[i+1] if i < len(posts)-1 else None
 
-    # Format navigation links
-    if prev_post:
-        prev_link = f"{prev_post['slug']}.html"
-        prev_title = prev_post['title']
-        prev_style = ""
+def fill_template(job, content):
+    # Create HTML file
+    return load_template(POST_TEMPLATE).render({
+        'title': job['title'],
+        'date': job['date'],
+        'content': content,
+        **job['nav'],
+        **job['assets'],
+    })
+
+
+def stage_output(path, data):
+    """Write `data` next to `path` for commit_outputs to move into place.
+
+    Returns the temp file, or None if `path` already holds exactly `data`,
+    in which case it is left alone, mtime and all. Comparing sizes first
+    means an existing file is only read when it could be identical.
+    """
+    try:
+        if path.stat().st_size == len(data) and path.read_bytes() == data:
+            return None
+    except FileNotFoundError:
+        pass
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with open(tmp_path, 'wb') as out:
+        out.write(data)
+    return tmp_path
+
+
+def commit_outputs(staged):
+    """Move staged files into place: (temp file, final path) pairs.
+
+    Every temp file is flushed to disk before any is renamed, and each
+    directory is synced once at the end, so a crash leaves either the old
+    file or the new one and a build pays for one batch of syncs, not one
+    per file.
+    """
+    for tmp_path, _ in staged:
+        fd = os.open(tmp_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    for tmp_path, path in staged:
+        tmp_path.replace(path)
+    for directory in {path.parent for _, path in staged}:
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            # Directories can't be opened for syncing on every platform
+            continue
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def write_output(path, data):
+    # Stage and commit a single file; returns whether it was written
+    tmp_path = stage_output(path, data)
+    if tmp_path is None:
+        return False
+    commit_outputs([(tmp_path, path)])
+    return True
+
+
+def finish_output(tmp_path, path):
+    # Commit a file that was streamed into `tmp_path`, unless `path` already
+    # holds the same bytes; returns whether it was written
+    if path.exists() and filecmp.cmp(tmp_path, path, shallow=False):
+        tmp_path.unlink()
+        return False
+    commit_outputs([(tmp_path, path)])
+    return True
+
+
+class StageTimer:
+    """Records wall time and size in and out of each stage of one render.
+
+    Does nothing unless enabled, so an ordinary build doesn't pay for
+    encoding every intermediate copy of a post just to measure it.
+    """
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.stages = {}
+        self.last = time.perf_counter()
+
+    def lap(self, name, text_in, text_out):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.stages[name] = {
+            'seconds': now - self.last,
+            'bytes_in': len(text_in if isinstance(text_in, bytes) else text_in.encode('utf-8')),
+            'bytes_out': len(text_out if isinstance(text_out, bytes) else text_out.encode('utf-8')),
+        }
+        # Leave the measuring out of the next stage's time
+        self.last = time.perf_counter()
+
+
+def render_page(job):
+    """Clean one post and write its page.
+
+    Runs in a worker process when building with --jobs, so everything it
+    needs comes in through `job` and everything it reports goes back in the
+    returned dict; the parent does all the printing.
+    """
+    stats = {} if job['cleanup_stats'] or job['profile'] else None
+    fallbacks = cleanup.fallbacks
+    timer = StageTimer(job['profile'])
+
+    # Read and clean HTML content. A Markdown post is converted instead; it
+    # has none of Substack's clutter to clean up.
+    mismatch = False
+    if job['markdown']:
+        source = markdown_content(job)
+        timer.lap('convert', source, source)
+        content = source
     else:
-        prev_link = "#"
-        prev_title = ""
-        prev_style = ' style="visibility: hidden;"'
-
-    if next_post:
-        next_link = f"{next_post['slug']}.html"
-        next_title = next_post['title']
-        next_style = ""
+        source = read_source(job['source_path'])
+        timer.lap('read', source, source)
+        content = clean_content(source, job['slug'], stats)
+        timer.lap('cleanup', source, content)
+        if job['verify_cleanup']:
+            mismatch = content != clean_content(source, job['slug'], sequential=True)
+            timer.lap('verify', source, content)
+
+    # Parse the post once; the page, the feeds and the search index are all
+    # made from the model. The feeds read it back from the cache.
+    model = parse_content(content)
+    del content
+    if job['cache_model']:
+        write_cache(content_cache_dir / f"{job['slug']}.json",
+                    json.dumps(model, separators=(',', ':'), ensure_ascii=False))
+    content = content_html(model)
+    timer.lap('parse', content, content)
+
+    # The parent builds the search index from these once every page is done
+    if job['search']:
+        terms = json.dumps(search_terms(model), separators=(',', ':'), ensure_ascii=False)
+        write_cache(search_cache_dir / f"{job['slug']}.json", terms)
+        timer.lap('search', content, terms)
+        del terms
+    del model
+
+    missing_images = 0
+    if job['images'] is not None:
+        cleaned = content
+        content, missing_images = mirror_images(content, job['images'])
+        timer.lap('images', cleaned, content)
+        del cleaned
+
+    # Minifying shrinks the content before the template indents it, and the
+    # whole page after
+    minified = None
+    if job['minify']:
+        unminified = content
+        content = minify_content(content)
+        timer.lap('minify', unminified, content)
+        saved = len(unminified.encode('utf-8')) - len(content.encode('utf-8'))
+        del unminified
+
+    # Drop each copy of the post as soon as the next one exists, so only a
+    # couple of copies of one post are ever alive at once
+    del source
+    page = fill_template(job, content)
+    timer.lap('fill', content, page)
+    del content
+    if job['minify']:
+        filled = page
+        page = minify_page(page.decode('utf-8')).encode('utf-8')
+        timer.lap('whitespace', filled, page)
+        minified = [len(filled) + saved, len(page)]
+        del filled
+    # serve keeps pages in memory instead. The parent moves staged pages
+    # into place once every page is rendered.
+    staged = None
+    if job['output_path'] is not None:
+        staged = stage_output(job['output_path'], page)
+        timer.lap('write', page, page)
+
+    return {
+        'stats': stats,
+        'fallback': cleanup.fallbacks > fallbacks,
+        'mismatch': mismatch,
+        'missing_images': missing_images,
+        'minified': minified,
+        'stages': timer.stages if job['profile'] else None,
+        'page': page if job['output_path'] is None else None,
+        'staged': staged,
+    }
+
+
+def compress_file(path):
+    """Stage the compressed siblings of one file. Runs in a worker process."""
+    data = path.read_bytes()
+    # mtime=0 keeps the gzip output the same from one build to the next
+    siblings = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        siblings['.br'] = brotli.compress(data, mode=brotli.MODE_TEXT, quality=11)
+    staged = []
+    for suffix, compressed in siblings.items():
+        sibling = path.with_name(path.name + suffix)
+        tmp_path = stage_output(sibling, compressed)
+        if tmp_path is not None:
+            staged.append((tmp_path, sibling))
+    return staged
+
+
+def precompress(paths, workers):
+    """Keep .gz and .br copies next to each of `paths`.
+
+    A file is only compressed again when its content changes: its hash is
+    cached, and trusted while its size and mtime stay the same, which they
+    do for pages the build left unchanged. Copies of files that are gone
+    are removed. Returns the number of files compressed.
+    """
+    cache = {}
+    if compressed_path.exists():
+        try:
+            with open(compressed_path, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            print(f"Warning: ignoring unreadable cache {compressed_path}")
+
+    formats = ['.gz', '.br'] if brotli is not None else ['.gz']
+    entries = {}
+    todo = []
+    for path in paths:
+        key = str(path.relative_to(site_dir))
+        stat = path.stat()
+        source_stat = [stat.st_mtime_ns, stat.st_size]
+        old_entry = cache.get(key, {})
+        content_hash = old_entry['hash'] if old_entry.get('stat') == source_stat else sha256_file(path)
+        entries[key] = {'stat': source_stat, 'hash': content_hash, 'formats': formats}
+        if (old_entry.get('hash') != content_hash or old_entry.get('formats') != formats
+                or not all(path.with_name(path.name + suffix).exists() for suffix in formats)):
+            todo.append(path)
+
+    # Remove copies that no longer match a file, or a format that can't be
+    # kept up to date any more
+    stale = [site_dir / key for key in cache.keys() - entries.keys()]
+    for path in sorted(stale) + [path for path in todo if '.br' not in formats]:
+        for suffix in ('.gz', '.br'):
+            sibling = path.with_name(path.name + suffix)
+            if (path in todo and suffix in formats) or not sibling.exists():
+                continue
+            sibling.unlink()
+            print(f"Removed: {sibling}")
+
+    if workers > 1 and len(todo) > 1:
+        with worker_pool(workers) as executor:
+            results = executor.map(compress_file, todo, chunksize=max(1, len(todo) // (workers * 4)))
+            staged = [pair for result in results for pair in result]
     else:
-        next_link = "#"
-        next_title = ""
-        next_style = ' style="visibility: hidden;"'
+        staged = [pair for path in todo for pair in compress_file(path)]
+    commit_outputs(staged)
+    for _, sibling in staged:
+        print(f"Created: {sibling}")
+
+    compressed_path.parent.mkdir(parents=True, exist_ok=True)
+    write_output(compressed_path, json.dumps(entries, indent=1, sort_keys=True).encode('utf-8'))
+    return len(todo)
+
+
+def search_terms(model):
+    # Every word of a parsed post, with the gaps between the positions it
+    # appears at. The blocks' text has no tags (or the inline images in
+    # their attributes), and is tokenized the same way search.js tokenizes
+    # a query.
+    words = itertools.chain.from_iterable(SEARCH_TOKEN.findall(block['text'].lower())
+                                          for block in model['blocks'])
+    terms = {}
+    for position, term in enumerate(words):
+        positions = terms.get(term)
+        if positions is None:
+            terms[term] = [position]
+        else:
+            positions.append(position)
+    return {term: [positions[0]] + [b - a for a, b in zip(positions, positions[1:])]
+            for term, positions in terms.items()}
+
+
+def search_shard(term):
+    # 32-bit FNV-1a over the code points, as in search.js
+    h = 0x811c9dc5
+    for ch in term:
+        h = ((h ^ ord(ch)) * 0x01000193) & 0xffffffff
+    return h % SEARCH_SHARDS
+
+
+def write_search_index(posts):
+    """Build search/ from the cached terms of every post.
+
+    index.json lists the posts and the shard files. A shard maps each of
+    its terms to a flat list of numbers: for each post holding the term, the
+    gap from the previous post's number, how many times it appears, then the
+    gaps between its positions. Shards are named after their content, so
+    they can be cached for good and unchanged ones are never written again.
+    Posts are numbered oldest first, so publishing one only changes the
+    shards holding its words.
+    """
+    shards = [{} for _ in range(SEARCH_SHARDS)]
+    # Each term's postings so far, and the last post added to them
+    term_postings = {}
+    last_doc = {}
+    docs = []
+    for doc, post in enumerate(reversed(posts)):
+        docs.append([post['slug'], post['title'], post['date_obj'].strftime('%Y-%m-%d') if post['date_obj'] else ''])
+        with open(search_cache_dir / f"{post['slug']}.json", 'r') as f:
+            terms = json.load(f)
+        for term, gaps in terms.items():
+            postings = term_postings.get(term)
+            if postings is None:
+                postings = term_postings[term] = shards[search_shard(term)][term] = [doc]
+            else:
+                postings.append(doc - last_doc[term])
+            postings.append(len(gaps))
+            postings.extend(gaps)
+            last_doc[term] = doc
+
+    search_dir.mkdir(exist_ok=True)
+    names = []
+    for number, shard in enumerate(shards):
+        data = json.dumps(dict(sorted(shard.items())),
+                          separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        name = f"terms-{number:02d}.{sha256(data)[:10]}.json"
+        names.append(name)
+        if write_output(search_dir / name, data):
+            print(f"Created: {search_dir / name}")
+
+    index = json.dumps({'version': 1, 'shards': names, 'docs': docs},
+                       separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    if write_output(search_dir / "index.json", index):
+        print(f"Created: {search_dir / 'index.json'}")
+    for old_path in search_dir.glob('terms-*.json'):
+        if old_path.name not in names:
+            old_path.unlink()
+            print(f"Removed: {old_path}")
+
+
+def index_entry(post):
+    # The index capitalizes titles and only shows the month
+    title = post['title'][:1].upper() + post['title'][1:]
+    month = post['date_obj'].strftime('%B %Y') if post['date_obj'] else ''
+    return f'      <li><a href="posts/{post["slug"]}.html">{title}</a> <span class="post-date">{month}</span></li>\n'
+
+
+def render_index(order, by_year):
+    groups = order.by_year() if by_year else [(None, order.posts)]
+
+    block = INDEX_START + '\n'
+    for year, group in groups:
+        if year is not None:
+            block += f'      <h3>{year}</h3>\n'
+        block += '      <ul>\n'
+        block += ''.join(index_entry(post) for post in group)
+        block += '      </ul>\n'
+    return block + '      ' + INDEX_END
+
+
+def splice_markers(page, start_marker, end_marker, block, what):
+    # Put `block` between a pair of markers in writing.html
+    start = page.find(start_marker)
+    end = page.find(end_marker, start)
+    if start == -1 or end == -1:
+        print(f"Warning: no {what} markers in {index_path}")
+        return None
+    return page[:start] + block + page[end + len(end_marker):]
+
+
+def splice_index(page, block):
+    return splice_markers(page, INDEX_START, INDEX_END, block, 'post index')
+
+
+def splice_feeds(page):
+    # Without its markers the page is left as it is
+    block = FEED_START + FEED_LINKS + FEED_END
+    return splice_markers(page, FEED_START, FEED_END, block, 'feed link') or page
+
+
+def splice_search(page, search):
+    # Without its markers the page is left as it is
+    block = SEARCH_START + (SEARCH_BOX if search else '') + SEARCH_END
+    return splice_markers(page, SEARCH_START, SEARCH_END, block, 'search box') or page
+
+
+def write_index(order, by_year, old_hash, search):
+    """Fill the post list in writing.html from the sorted posts.
+
+    The feed links go in too, and the search box when `search` is true.
+    Returns the hash of all of them, which goes in the manifest; the page
+    is only touched when that changes.
+    """
+    block = render_index(order, by_year)
+    index_hash = sha256(json.dumps([block, FEED_LINKS, search]))
+    if index_hash == old_hash:
+        return index_hash
+
+    with open(index_path, 'r') as f:
+        page = f.read()
+    new_page = splice_index(page, block)
+    if new_page is None:
+        return None
+    new_page = splice_search(splice_feeds(new_page), search)
+    if write_output(index_path, new_page.encode('utf-8')):
+        print(f"Created: {index_path}")
+    return index_hash
+
+
+def xml_escape(text):
+    return html.escape(XML_INVALID.sub('', text))
+
+
+def w3c_time(dt):
+    return dt.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def page_url(path):
+    # index.html is the site's root
+    key = path.relative_to(site_dir).as_posix()
+    return SITE_URL if key == 'index.html' else SITE_URL + key
+
+
+def track_lastmod(paths):
+    """Work out when each of `paths` last changed, as W3C datetimes.
 
-    # Indent content for template
-    indented_content = '\n'.join('      ' + line if line.strip() else ''
-                                  for line in post['content'].split('\n'))
+    A file's time only moves when its content hash does, so the sitemap and
+    feeds keep their dates through builds that change nothing. As in
+    precompress, a cached hash is trusted while the size and mtime hold. A
+    file seen for the first time gets its mtime, which the build leaves
+    alone on pages that render the same.
+    """
+    cache = {}
+    if lastmod_path.exists():
+        try:
+            with open(lastmod_path, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            print(f"Warning: ignoring unreadable cache {lastmod_path}")
+
+    now = w3c_time(datetime.now(timezone.utc))
+    entries = {}
+    lastmod = {}
+    for path in paths:
+        key = str(path.relative_to(site_dir))
+        stat = path.stat()
+        source_stat = [stat.st_mtime_ns, stat.st_size]
+        entry = cache.get(key)
+        if entry is None or entry['stat'] != source_stat:
+            content_hash = sha256_file(path)
+            if entry is None:
+                modified = w3c_time(datetime.fromtimestamp(stat.st_mtime, timezone.utc))
+            elif entry['hash'] != content_hash:
+                modified = now
+            else:
+                modified = entry['modified']
+            entry = {'stat': source_stat, 'hash': content_hash, 'modified': modified}
+        entries[key] = entry
+        lastmod[path] = entry['modified']
+
+    lastmod_path.parent.mkdir(parents=True, exist_ok=True)
+    write_output(lastmod_path, json.dumps(entries, indent=1, sort_keys=True).encode('utf-8'))
+    return lastmod
+
+
+def write_sitemap(lastmod):
+    # Every page in `lastmod`, in its order, dated by its last change
+    urls = ''.join(f"  <url><loc>{xml_escape(page_url(path))}</loc><lastmod>{modified}</lastmod></url>\n"
+                   for path, modified in lastmod.items())
+    sitemap = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+               f'{urls}</urlset>\n')
+    if write_output(sitemap_path, sitemap.encode('utf-8')):
+        print(f"Created: {sitemap_path}")
+
+
+def post_summary(model):
+    # The start of a parsed post's text, cut at a word. Only the first few
+    # blocks are ever looked at.
+    text = ''
+    for block in model['blocks']:
+        if block['text']:
+            text = f"{text} {block['text']}" if text else block['text']
+        if len(text) > FEED_SUMMARY_LENGTH:
+            break
+    if len(text) <= FEED_SUMMARY_LENGTH:
+        return text
+    return text[:FEED_SUMMARY_LENGTH].rsplit(' ', 1)[0] + '…'
+
+
+def write_feeds(posts, lastmod, summary):
+    """Write the Atom feed.xml and the RSS rss.xml for `posts`, newest first.
+
+    Both are streamed in one pass: each post's cached model is loaded,
+    written into both feeds and dropped, so even a feed of every post only
+    ever holds one of them. Entries are dated by the last change to their
+    page and a feed by its newest entry, and a feed that comes out the same
+    is left alone, so readers' conditional requests keep getting answered
+    with 304s.
+    """
+    pages = [output_dir / f"{post['slug']}.html" for post in posts]
+    updated = max((lastmod[page] for page in pages), default=None) or w3c_time(datetime.now(timezone.utc))
+    feed_url = xml_escape(page_url(feed_path))
+    index_url = xml_escape(page_url(index_path))
+    rss_updated = email.utils.format_datetime(datetime.fromisoformat(updated.replace('Z', '+00:00')))
+
+    atom_tmp = feed_path.with_name(f"{feed_path.name}.tmp")
+    rss_tmp = rss_path.with_name(f"{rss_path.name}.tmp")
+    with open(atom_tmp, 'w', encoding='utf-8') as atom, open(rss_tmp, 'w', encoding='utf-8') as rss:
+        atom.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                   '<feed xmlns="http://www.w3.org/2005/Atom">\n'
+                   f'  <title>{xml_escape(FEED_TITLE)}</title>\n'
+                   f'  <id>{feed_url}</id>\n'
+                   f'  <link rel="self" href="{feed_url}"/>\n'
+                   f'  <link rel="alternate" type="text/html" href="{index_url}"/>\n'
+                   f'  <author><name>{xml_escape(FEED_AUTHOR)}</name></author>\n'
+                   f'  <updated>{updated}</updated>\n')
+        rss.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                  '<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom">\n'
+                  '<channel>\n'
+                  f'  <title>{xml_escape(FEED_TITLE)}</title>\n'
+                  f'  <link>{index_url}</link>\n'
+                  f'  <atom:link rel="self" type="application/rss+xml" href="{xml_escape(page_url(rss_path))}"/>\n'
+                  f'  <description>Writing by {xml_escape(FEED_AUTHOR)}</description>\n'
+                  f'  <lastBuildDate>{rss_updated}</lastBuildDate>\n')
+
+        for post, page in zip(posts, pages):
+            url = xml_escape(page_url(page))
+            title = xml_escape(post['title'])
+            # Images stay on Substack's CDN here even with --mirror-images:
+            # those links are absolute, so they work from a feed reader
+            model = load_model(post['slug'])
+            body = xml_escape(post_summary(model) if summary else content_html(model))
+            del model
+
+            atom.write('  <entry>\n'
+                       f'    <title>{title}</title>\n'
+                       f'    <id>{url}</id>\n'
+                       f'    <link rel="alternate" type="text/html" href="{url}"/>\n')
+            if post['date_obj']:
+                atom.write(f'    <published>{w3c_time(post["date_obj"])}</published>\n')
+            atom.write(f'    <updated>{lastmod[page]}</updated>\n')
+            if summary:
+                atom.write(f'    <summary>{body}</summary>\n')
+            else:
+                atom.write(f'    <content type="html">{body}</content>\n')
+            atom.write('  </entry>\n')
+
+            rss.write('  <item>\n'
+                      f'    <title>{title}</title>\n'
+                      f'    <link>{url}</link>\n'
+                      f'    <guid isPermaLink="true">{url}</guid>\n')
+            if post['date_obj']:
+                rss.write(f'    <pubDate>{email.utils.format_datetime(post["date_obj"])}</pubDate>\n')
+            rss.write(f'    <description>{body}</description>\n'
+                      '  </item>\n')
+            del body
+
+        atom.write('</feed>\n')
+        rss.write('</channel>\n'
+                  '</rss>\n')
+
+    for tmp_path, path in ((atom_tmp, feed_path), (rss_tmp, rss_path)):
+        if finish_output(tmp_path, path):
+            print(f"Created: {path}")
+
+
+def page_links(path):
+    """The links out of one page, script or manifest, and the ids in it.
+
+    Runs in a worker process. Each link is [kind, url]: 'href' for a link
+    to follow, 'src' for something the page uses, and 'load' for a script
+    or JSON file whose own links the page ends up using.
+    """
+    text = path.read_text(errors='replace')
+    links = []
+    ids = []
+    if path.suffix == '.json':
+        # A manifest like torties/manifest.json, fetched by a page
+        def walk(value):
+            if isinstance(value, dict):
+                for key, item in value.items():
+                    if key in ('src', 'href') and isinstance(item, str):
+                        links.append(['src', item])
+                    elif key == 'srcset' and isinstance(item, str):
+                        links.extend(['src', url] for url in srcset_urls(item))
+                    else:
+                        walk(item)
+            elif isinstance(value, list):
+                for item in value:
+                    walk(item)
+        try:
+            walk(json.loads(text))
+        except ValueError:
+            pass
+        return {'links': links, 'ids': ids}
+
+    if path.suffix == '.html':
+        text = MINIFY_COMMENT.sub('', text)
+        for tag in CHECK_TAG.finditer(text):
+            name = tag.group(1).lower()
+            for attribute, value in CHECK_ATTRIBUTE.findall(tag.group()):
+                value = html.unescape(value[1:-1])
+                if attribute.lower() == 'srcset':
+                    links.extend(['src', url] for url in srcset_urls(value))
+                elif name == 'a':
+                    links.append(['href', value])
+                elif name == 'script':
+                    links.append(['load', value])
+                else:
+                    links.append(['src', value])
+        ids = sorted(set(CHECK_ID.findall(text)))
+    # Pages change location from scripts, and index.html fetches its
+    # torties; only literal URLs can be followed
+    for m in CHECK_SCRIPT.finditer(text):
+        if m.group(2):
+            links.append(['href', m.group(2)])
+        else:
+            links.append(['load' if m.group(4).endswith('.json') else 'src', m.group(4)])
+    return {'links': links, 'ids': ids}
+
+
+def srcset_urls(srcset):
+    # Substack's CDN URLs have commas in them, so split on the descriptors
+    return [token.rstrip(',') for token in srcset.split()
+            if not re.fullmatch(r'\d+(?:\.\d+)?[wx],?', token)]
+
+
+def resolve_link(key, url):
+    # The file a link on page `key` points at, relative to the site, and its
+    # fragment; None for a link off the site. Browsers ignore the spaces
+    # around a URL, and so does this.
+    url = url.strip(' \t\n\r\f')
+    if not url or CHECK_EXTERNAL.match(url):
+        return None
+    url, _, fragment = url.partition('#')
+    url = urllib.parse.unquote(url.partition('?')[0])
+    if not url:
+        return key, fragment
+    target = posixpath.normpath(url.lstrip('/') if url.startswith('/')
+                                else posixpath.join(posixpath.dirname(key), url))
+    if url.endswith('/') or (site_dir / target).is_dir():
+        target = posixpath.join(target, 'index.html')
+    return target, fragment
+
+
+def check_site(workers):
+    """Check that every link and asset the site's pages use is there.
+
+    Offline: the hand-written pages and the generated posts are read from
+    disk, along with the scripts and manifests they load, and every local
+    link, script, stylesheet and image is looked up. Reports broken links
+    (anchors included), missing assets, posts no other page links to and
+    files over CHECK_SIZE_LIMITS. Each file's links are cached by its hash,
+    which is trusted while its size and mtime stay the same, so only
+    changed files are read again. Returns the number of problems.
+    """
+    cache = {}
+    if checked_path.exists():
+        try:
+            with open(checked_path, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            print(f"Warning: ignoring unreadable cache {checked_path}")
+
+    pages = [str(path.relative_to(site_dir)) for path in sorted(site_dir.glob('*.html')) + sorted(output_dir.glob('*.html'))]
+    entries = {}
+    parsed = 0
+    queue = pages
+    while queue:
+        todo = []
+        for key in queue:
+            path = site_dir / key
+            stat = path.stat()
+            source_stat = [stat.st_mtime_ns, stat.st_size]
+            old_entry = cache.get(key, {})
+            content_hash = old_entry['hash'] if old_entry.get('stat') == source_stat else sha256_file(path)
+            if old_entry.get('hash') == content_hash:
+                entries[key] = dict(old_entry, stat=source_stat)
+            else:
+                entries[key] = {'stat': source_stat, 'hash': content_hash}
+                todo.append(key)
+        if workers > 1 and len(todo) > 1:
+            with worker_pool(workers) as executor:
+                results = list(executor.map(page_links, [site_dir / key for key in todo],
+                                            chunksize=max(1, len(todo) // (workers * 4))))
+        else:
+            results = [page_links(site_dir / key) for key in todo]
+        for key, result in zip(todo, results):
+            entries[key].update(result)
+        parsed += len(todo)
+
+        # Then the scripts and manifests those pages load
+        queue = sorted({target for key in queue for kind, url in entries[key]['links'] if kind == 'load'
+                        for target, _ in [resolve_link(key, url) or (None, None)]
+                        if target and target not in entries and (site_dir / target).is_file()})
+
+    def used_links(key, url_base, seen):
+        # A page's own links, and those of what it loads, which resolve
+        # against the page rather than the script
+        for kind, url in entries[key]['links']:
+            yield kind, url
+            resolved = resolve_link(url_base, url) if kind == 'load' else None
+            if resolved and resolved[0] in entries and resolved[0] not in seen:
+                seen.add(resolved[0])
+                yield from used_links(resolved[0], url_base, seen)
+
+    problems = {'broken': 0, 'missing': 0, 'orphaned': 0, 'oversized': 0}
+    inbound = {key: set() for key in pages}
+    used = set(pages)
+    for key in pages:
+        reported = set()
+        for kind, url in used_links(key, key, {key}):
+            resolved = resolve_link(key, url)
+            if resolved is None or (kind, url) in reported:
+                continue
+            target, fragment = resolved
+            if not (site_dir / target).is_file():
+                reported.add((kind, url))
+                problems['broken' if kind == 'href' else 'missing'] += 1
+                print(f"{'Broken' if kind == 'href' else 'Missing'}: {key} -> {url}")
+                continue
+            used.add(target)
+            if kind != 'href':
+                continue
+            if target != key:
+                inbound.setdefault(target, set()).add(key)
+            if fragment and target in entries and fragment not in entries[target].get('ids', ()):
+                reported.add((kind, url))
+                problems['broken'] += 1
+                print(f"Broken: {key} -> {url} (no #{fragment} there)")
+
+    for key in pages:
+        if key.startswith(f"{output_dir.name}/") and not inbound[key]:
+            problems['orphaned'] += 1
+            print(f"Orphaned: {key} (no page links to it)")
+
+    for key in sorted(used):
+        limit = CHECK_SIZE_LIMITS.get(posixpath.splitext(key)[1].lower())
+        size = (site_dir / key).stat().st_size
+        if limit and size > limit:
+            problems['oversized'] += 1
+            print(f"Oversized: {key} ({size / 1024:.0f} KiB, limit {limit // 1024} KiB)")
+
+    checked_path.parent.mkdir(parents=True, exist_ok=True)
+    write_output(checked_path, json.dumps(entries, indent=1, sort_keys=True).encode('utf-8'))
+    print(f"Done checking {len(pages)} pages! ({parsed} read, {len(entries) - parsed} unchanged; "
+          f"{problems['broken']} broken links, {problems['missing']} missing assets, "
+          f"{problems['orphaned']} orphaned posts, {problems['oversized']} oversized files)")
+    return sum(problems.values())
+
+
+def post_sort_key(post):
+    # Newest first, undated posts last; posts from the same moment go by
+    # post_id, so the order never depends on the order of posts.csv
+    date = post['date_obj']
+    return (date is None, -date.timestamp() if date else 0.0, post['post_id'])
+
+
+def sort_posts(posts):
+    # Sort posts by date (newest first)
+    posts.sort(key=post_sort_key)
+
+
+class PostOrder:
+    """The sorted posts, indexed in one pass for everything that walks them.
+
+    Page navigation, the writing index, the feeds and the year headings all
+    read from this: a post's neighbours are a lookup by slug and each year
+    is a slice, rather than a search through the list.
+    """
+
+    def __init__(self, posts):
+        self.posts = posts
+        self.positions = {}
+        # [year, start, end] of each run of posts from one year; undated
+        # posts come last with year None
+        self.years = []
+        for i, post in enumerate(posts):
+            self.positions[post['slug']] = i
+            year = post['date_obj'].year if post['date_obj'] else None
+            if self.years and self.years[-1][0] == year:
+                self.years[-1][2] = i + 1
+            else:
+                self.years.append([year, i, i + 1])
+
+    def neighbours(self, slug):
+        # The newer and the older post next to this one, or None at the ends
+        i = self.positions[slug]
+        return (self.posts[i - 1] if i > 0 else None,
+                self.posts[i + 1] if i + 1 < len(self.posts) else None)
+
+    def by_year(self):
+        return [(year, self.posts[start:end]) for year, start, end in self.years]
+
+    def newest(self, count):
+        # The newest `count` posts, or all of them if `count` isn't positive
+        return self.posts[:count] if count > 0 else self.posts
+
+
+def plan_pages(order, old_entries, options, pages_dir=None):
+    """Work out which pages need rendering.
+
+    Returns the manifest entries for every post and a render_page job for
+    each page whose inputs changed. This pass needs the whole sorted list,
+    so it stays serial; it is cheap next to the rendering itself. Pages go
+    in posts/ unless given another `pages_dir`.
+    """
+    pages_dir = pages_dir or output_dir
+    new_entries = {}
+    jobs = []
+    for post in order.posts:
+        # Determine prev/next posts
+        # "came right after" = newer (previous in the list)
+        # "came right before" = older (next in the list)
+        prev_post, next_post = order.neighbours(post['slug'])
+
+        # Only the slug and title of a neighbour end up on this page
+        entry = {
+            'source': post['source_hash'],
+            'source_stat': post['source_stat'],
+            'markdown': MARKDOWN_VERSION if post['markdown'] else None,
+            'row': post['row_hash'],
+            'prev': sha256(json.dumps([prev_post['slug'], prev_post['title']])) if prev_post else None,
+            'next': sha256(json.dumps([next_post['slug'], next_post['title']])) if next_post else None,
+            'images': sha256(json.dumps(options['images'])) if options['images'] else None,
+            'minify': MINIFY_VERSION if options['minify'] else None,
+        }
+        new_entries[post['slug']] = entry
+
+        output_path = pages_dir / f"{post['slug']}.html"
+        old_entry = old_entries.get(post['slug'])
+        if (old_entry is not None and output_path.exists()
+                and all(old_entry.get(key) == entry[key] for key in RENDER_INPUTS)):
+            continue
 
-    # Create HTML file
-    html = template.format(
-        title=post['title'],
-        date=post['date'],
-        content=indented_content,
-        prev_link=prev_link,
-        prev_title=prev_title,
-        prev_style=prev_style,
-        next_link=next_link,
-        next_title=next_title,
-        next_style=next_style
-    )
-
-    output_path = output_dir / f"{post['slug']}.html"
-    with open(output_path, 'w') as out:
-        out.write(html)
-
-    print(f"Created: {output_path}")
-
-print("Done generating post pages!")
+        jobs.append({
+            'slug': post['slug'],
+            'title': post['title'],
+            'date': post['date'],
+            'source_path': post['source_path'],
+            'source_hash': post['source_hash'],
+            'markdown': post['markdown'],
+            'output_path': output_path,
+            'nav': navigation(prev_post, next_post),
+            **options,
+        })
+    return new_entries, jobs
+
+
+def build_preview(args):
+    """Render every post in posts.csv, drafts and scheduled posts too, into preview/.
+
+    The previews link to each other in the same order the site would show
+    them, with a draft's or scheduled post's status in place of its date.
+    Nothing outside preview/ changes; the index, search, feeds and sitemap
+    only ever list published posts, and no model of a preview goes in
+    .build-cache/content/, which the feeds read. As on the site, a preview
+    is only rendered again when its inputs change.
+    """
+    preview_dir.mkdir(exist_ok=True)
+    for tmp_path in preview_dir.glob('*.html.tmp'):
+        tmp_path.unlink()
+    templates.clear()
+    assets = publish_assets()
+    template_hash = sha256(json.dumps([load_template(POST_TEMPLATE).hash, assets]))
+    old_entries = load_manifest(args.force, template_hash, preview_manifest_path).get('posts', {})
+
+    posts = list(scan_posts(old_entries, drafts=True))
+    for post in posts:
+        if post['status'] == 'draft':
+            post['date'] = f"Draft, {post['date']}" if post['date'] else "Draft"
+        elif post['status'] == 'scheduled':
+            post['date'] = f"Scheduled for {post['date']}"
+        # The status shows on the page, so a change of status renders it again
+        post['row_hash'] = sha256(json.dumps([post['row_hash'], post['status']]))
+    sort_posts(posts)
+
+    options = {
+        'assets': assets,
+        'images': mirror_settings(args),
+        'cleanup_stats': False,
+        'verify_cleanup': False,
+        'profile': False,
+        'search': False,
+        'minify': args.minify,
+        'cache_model': False,
+    }
+    if any(post['markdown'] for post in posts):
+        markdown_cache_dir.mkdir(parents=True, exist_ok=True)
+    new_entries, jobs = plan_pages(PostOrder(posts), old_entries, options, preview_dir)
+
+    workers = args.jobs if args.jobs > 0 else os.cpu_count()
+    staged = []
+    with contextlib.ExitStack() as stack:
+        if workers > 1 and len(jobs) > 1:
+            executor = stack.enter_context(worker_pool(workers))
+            results = executor.map(render_page, jobs, chunksize=max(1, len(jobs) // (workers * 4)))
+        else:
+            results = map(render_page, jobs)
+        for job, result in zip(jobs, results):
+            if result['missing_images']:
+                new_entries[job['slug']]['images'] = 'incomplete'
+            if result['staged'] is not None:
+                staged.append((result['staged'], job['output_path']))
+    commit_outputs(staged)
+    for _, path in staged:
+        print(f"Created: {path}")
+
+    for slug in sorted(old_entries.keys() - new_entries.keys()):
+        stale_path = preview_dir / f"{slug}.html"
+        if stale_path.exists():
+            stale_path.unlink()
+            print(f"Removed: {stale_path}")
+    save_manifest(new_entries, template_hash, preview_manifest_path)
+
+    drafts = sum(post['status'] == 'draft' for post in posts)
+    scheduled = sum(post['status'] == 'scheduled' for post in posts)
+    print(f"Done previewing {len(posts)} posts! ({len(staged)} written, {len(posts) - len(staged)} unchanged; "
+          f"{drafts} drafts, {scheduled} scheduled)")
+
+
+def post_profile(job, result):
+    # One post's entry in the --profile trace
+    stages = result['stages']
+    return {
+        'slug': job['slug'],
+        'source': str(job['source_path']),
+        'seconds': sum(stage['seconds'] for stage in stages.values()),
+        # 'read' for an export, 'convert' for a Markdown post
+        'bytes_in': next(iter(stages.values()))['bytes_in'],
+        'bytes_out': stages['write']['bytes_out'],
+        'fallback': result['fallback'],
+        'stages': stages,
+        'rules': {name: {'matches': matches, 'seconds': seconds, 'bytes_removed': removed}
+                  for name, (matches, seconds, removed) in result['stats'].items()},
+    }
+
+
+def write_profile(path, phases, posts, workers, top):
+    """Write the --profile trace and print the slowest posts and rules.
+
+    The trace has totals per build phase, render stage and cleanup rule, the
+    slowest posts, rules and single rule runs, and then every post's own
+    numbers, so one pathological export stands out without a debugger.
+    """
+    stages = {}
+    rules = {}
+    for post in posts:
+        for name, stage in post['stages'].items():
+            total = stages.setdefault(name, {'seconds': 0.0, 'bytes_in': 0, 'bytes_out': 0})
+            for key in total:
+                total[key] += stage[key]
+        for name, rule in post['rules'].items():
+            total = rules.setdefault(name, {'matches': 0, 'seconds': 0.0, 'bytes_removed': 0})
+            for key in total:
+                total[key] += rule[key]
+
+    slowest_posts = sorted(posts, key=lambda post: post['seconds'], reverse=True)[:top]
+    slowest_rules = sorted(rules.items(), key=lambda item: item[1]['seconds'], reverse=True)[:top]
+    rule_runs = sorted(((post['slug'], name, rule) for post in posts for name, rule in post['rules'].items()),
+                       key=lambda run: run[2]['seconds'], reverse=True)[:top]
+
+    trace = {
+        'version': 1,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'workers': workers,
+        'posts_rendered': len(posts),
+        'phases': phases,
+        'stages': stages,
+        'rules': rules,
+        'slowest_posts': [{'slug': post['slug'], 'seconds': post['seconds'], 'bytes_in': post['bytes_in']}
+                          for post in slowest_posts],
+        'slowest_rules': [{'rule': name, **rule} for name, rule in slowest_rules],
+        'slowest_rule_runs': [{'slug': slug, 'rule': name, **rule} for slug, name, rule in rule_runs],
+        'posts': posts,
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(trace, f, indent=1)
+    tmp_path.replace(path)
+
+    print(f"Slowest posts ({len(posts)} rendered):")
+    for post in slowest_posts:
+        print(f"  {post['slug']:<40} {post['seconds'] * 1000:>9.2f} ms {post['bytes_in'] / 1024:>9.1f} KiB")
+    print("Slowest cleanup rules in a single post:")
+    for slug, name, rule in rule_runs:
+        print(f"  {name:<22} {slug:<40} {rule['seconds'] * 1000:>9.2f} ms")
+    print(f"Saved: {path}")
+
+
+def mirror_settings(args):
+    if not args.mirror_images:
+        return None
+    if Image is None:
+        print("Warning: Pillow is not installed; leaving images on Substack's CDN")
+        return None
+    return {'source': args.image_source, 'origin': args.image_origin}
+
+
+class BuildState:
+    """What `daemon` keeps in memory from one build to the next.
+
+    posts.csv is only parsed again when it changes, and a post whose row
+    and source file are untouched keeps its scanned metadata. The sorted
+    list is patched rather than sorted again: posts that changed or went
+    away come out, and changed and new ones go back in where they sort.
+    The manifest is kept too, and only read back if something else has
+    written it since.
+    """
+
+    def __init__(self):
+        self.csv_stamp = None
+        self.rows = None
+        self.posts = {}
+        self.sorted = []
+        self.manifest = None
+        self.manifest_stamp = None
+        # When the next scheduled post goes live, if there is one
+        self.goes_live = None
+
+    def load_manifest(self, force, template_hash):
+        if (self.manifest is None or force or file_stamp(manifest_path) != self.manifest_stamp
+                or self.manifest.get('template') != template_hash):
+            return load_manifest(force, template_hash)
+        return self.manifest
+
+    def save_manifest(self, manifest):
+        self.manifest = manifest
+        self.manifest_stamp = file_stamp(manifest_path)
+
+    def scan_posts(self, old_entries):
+        stamp = file_stamp(csv_path)
+        if stamp is None or stamp != self.csv_stamp:
+            self.rows = read_rows()
+            self.csv_stamp = stamp
+        return list(scan_posts(old_entries, self.rows, self.posts))
+
+    def sort_posts(self, posts):
+        # Returns the posts sorted, as sort_posts() would
+        by_slug = {post['slug']: post for post in posts}
+        if not self.sorted or len(by_slug) != len(posts):
+            ordered = sorted(posts, key=post_sort_key)
+        else:
+            # scan_posts() hands back the same dict for an unchanged post
+            moved = [post for slug, post in by_slug.items() if self.posts.get(slug) is not post]
+            ordered = [post for post in self.sorted if by_slug.get(post['slug']) is post]
+            keys = [post_sort_key(post) for post in ordered]
+            for post in moved:
+                key = post_sort_key(post)
+                at = bisect.bisect(keys, key)
+                keys.insert(at, key)
+                ordered.insert(at, post)
+        self.posts = by_slug
+        self.sorted = ordered
+        return list(ordered)
+
+
+class LiveSite:
+    """The site as `serve` shows it.
+
+    Post pages and the writing index are rendered from the sources when
+    first asked for and kept in memory; nothing under posts/ is written.
+    With --watch, poll() notices edited sources, drops just the pages they
+    affect and tells open browsers which pages to reload, so an edit costs
+    one re-render however big the archive is.
+    """
+
+    def __init__(self, options, by_year):
+        self.options = options
+        self.by_year = by_year
+        self.changed = threading.Condition()
+        self.version = 0
+        self.reloads = []
+        self.pages = {}
+        self.entries = {}
+        self.load_posts()
+        self.stamps = self.watched_stamps()
+
+    def load_posts(self):
+        # Rescan posts.csv; returns the slugs whose pages are now different
+        posts = [post for post in scan_posts(self.entries) if post['status'] == 'published']
+        sort_posts(posts)
+        order = PostOrder(posts)
+        entries, jobs = plan_pages(order, {}, self.options)
+        # Edited sources are picked up by their own stamps
+        changed = {slug for slug in self.entries.keys() | entries.keys()
+                   if slug not in self.entries or slug not in entries
+                   or any(self.entries[slug][key] != entries[slug][key] for key in ('row', 'prev', 'next'))}
+        self.order = order
+        self.entries = entries
+        self.jobs = {job['slug']: dict(job, output_path=None) for job in jobs}
+        self.sources = {job['source_path']: job['slug'] for job in jobs}
+        return changed
+
+    def watched_stamps(self):
+        stamps = {}
+        watched = [csv_path, index_path, *self.sources]
+        watched += [templates_dir / name for name in load_template(POST_TEMPLATE).sources]
+        watched += [source for _, source in asset_sources()]
+        for path in watched:
+            try:
+                stat = path.stat()
+                stamps[path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                stamps[path] = None
+        return stamps
+
+    def render(self, path):
+        # Called with the lock held
+        if path == '/writing.html':
+            with open(index_path, 'r') as f:
+                page = splice_index(f.read(), render_index(self.order, self.by_year))
+            if page is None:
+                return None
+            page = page.encode('utf-8')
+        elif path.startswith('/posts/') and path.endswith('.html') and path[7:-5] in self.jobs:
+            page = render_page(self.jobs[path[7:-5]])['page']
+        else:
+            return None
+        script = LIVE_RELOAD_SCRIPT.encode('utf-8')
+        at = page.rfind(b'</body>')
+        return page[:at] + script + page[at:] if at != -1 else page + script
+
+    def page(self, path):
+        with self.changed:
+            if path not in self.pages:
+                page = self.render(path)
+                if page is None:
+                    return None
+                self.pages[path] = page
+            return self.pages[path]
+
+    def poll(self):
+        # Stat everything outside the lock; it's the slow part
+        stamps = self.watched_stamps()
+        changed_paths = [path for path in stamps if stamps[path] != self.stamps.get(path)]
+        if not changed_paths:
+            return
+        for path in changed_paths:
+            print(f"Changed: {path}")
+
+        with self.changed:
+            reloads = set()
+            assets = {source for _, source in asset_sources()}
+            if any(path.parent == templates_dir or path in assets for path in changed_paths):
+                # Every page uses the template and links to the assets by
+                # fingerprint
+                templates.clear()
+                self.options['assets'] = publish_assets()
+                self.load_posts()
+                reloads.add('*')
+            elif csv_path in changed_paths:
+                # New titles, dates and neighbours; the index always changes
+                reloads.update(f'/posts/{slug}.html' for slug in self.load_posts())
+                reloads.add('/writing.html')
+            if index_path in changed_paths:
+                reloads.add('/writing.html')
+            reloads.update(f'/posts/{self.sources[path]}.html' for path in changed_paths if path in self.sources)
+
+            # Re-render straight away the pages someone has open, so their
+            # reload doesn't wait; the rest are rendered if asked for
+            if '*' in reloads:
+                self.pages.clear()
+            for path in reloads:
+                if self.pages.pop(path, None) is not None:
+                    page = self.render(path)
+                    if page is not None:
+                        self.pages[path] = page
+                    print(f"Rendered: {path}")
+
+            self.stamps = self.watched_stamps() if csv_path in changed_paths else stamps
+            self.version += 1
+            self.reloads = sorted(reloads)
+            self.changed.notify_all()
+
+
+class LiveHandler(http.server.SimpleHTTPRequestHandler):
+    # Serves the LiveSite's pages from memory and everything else from disk
+
+    def __init__(self, *args, site, **kwargs):
+        self.site = site
+        super().__init__(*args, directory=str(site_dir), **kwargs)
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if path == LIVE_RELOAD_PATH:
+            return self.send_reloads()
+        page = self.site.page(path)
+        if page is None:
+            return super().do_GET()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(page)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(page)
+
+    def send_reloads(self):
+        # A server-sent event stream with the list of changed pages after
+        # each change; the comment lines keep idle connections checked
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        site = self.site
+        with site.changed:
+            version = site.version
+        try:
+            while True:
+                with site.changed:
+                    site.changed.wait_for(lambda: site.version != version, timeout=15)
+                    message = ': idle\n\n' if site.version == version else f'data: {json.dumps(site.reloads)}\n\n'
+                    version = site.version
+                self.wfile.write(message.encode('utf-8'))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def serve(args):
+    """Serve the site locally, rendering post pages on request.
+
+    With --watch, keeps checking posts.csv, the exported posts, writing.html,
+    the templates and the shared assets, and reloads open pages when they
+    change.
+    """
+    options = {
+        'assets': publish_assets(),
+        'images': mirror_settings(args),
+        'cleanup_stats': False,
+        'verify_cleanup': False,
+        'profile': False,
+        'search': False,
+        'minify': args.minify,
+        'cache_model': False,
+    }
+    site = LiveSite(options, args.index_by_year)
+
+    server = http.server.ThreadingHTTPServer(
+        (args.bind, args.port), lambda *handler_args: LiveHandler(*handler_args, site=site))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print(f"Serving {site_dir} at http://{args.bind}:{args.port}/ ({len(site.order.posts)} posts)")
+
+    try:
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            if args.watch:
+                site.poll()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """One request to the daemon: a JSON list of build options on one line.
+
+    The build's output is sent back as it's printed, then DAEMON_STATUS and
+    its exit status.
+    """
+
+    def handle(self):
+        try:
+            extra = json.loads(self.rfile.readline() or b'[]')
+        except ValueError:
+            extra = None
+        out = io.TextIOWrapper(self.wfile, encoding='utf-8', line_buffering=True)
+        try:
+            if isinstance(extra, list) and all(isinstance(arg, str) for arg in extra):
+                status = self.server.run_build(extra, out)
+            else:
+                out.write("Error: expected a JSON list of build options\n")
+                status = 2
+            out.write(f"{DAEMON_STATUS}{status}\n")
+            out.flush()
+        except OSError:
+            # The client went away; the build itself still counts
+            pass
+        finally:
+            out.detach()
+
+
+class ThreadOutput(io.TextIOBase):
+    """sys.stdout or sys.stderr while the daemon runs.
+
+    Installed once when the daemon starts. Each thread writes to the stream
+    routed to it, if any, and otherwise to the daemon's own: a request's
+    build goes back down its socket while everything else the daemon
+    prints, from any thread, stays in its log.
+    """
+
+    def __init__(self, default):
+        self.default = default
+        self.routes = threading.local()
+
+    def stream(self):
+        return getattr(self.routes, 'stream', None) or self.default
+
+    def write(self, text):
+        return self.stream().write(text)
+
+    def flush(self):
+        self.stream().flush()
+
+    @contextlib.contextmanager
+    def routed(self, stream):
+        # Send this thread's output to `stream` for the duration
+        self.routes.stream = stream
+        try:
+            yield
+        finally:
+            self.routes.stream = None
+
+
+def daemon(args, argv):
+    """Stay running and build whenever asked, keeping a BuildState warm.
+
+    Builds are requested by `rebuild`, which talks to the daemon over a Unix
+    socket in .build-cache/, or by touching the trigger file (--trigger,
+    .build-cache/rebuild by default), and it builds by itself when a
+    scheduled post's time comes. A request can add options to the ones the
+    daemon was started with, but not change its paths. Builds run one at a
+    time.
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        raise SystemExit("daemon needs Unix sockets; use build instead")
+    with contextlib.suppress(OSError), socket.socket(socket.AF_UNIX) as probe:
+        probe.connect(str(daemon_socket_path))
+        raise SystemExit(f"A daemon is already building {site_dir}")
+    daemon_socket_path.parent.mkdir(parents=True, exist_ok=True)
+    daemon_socket_path.unlink(missing_ok=True)
+
+    state = BuildState()
+    lock = threading.Lock()
+    paths = [path.resolve() for path in (args.site, args.csv, args.sources)]
+    stdout, stderr = ThreadOutput(sys.stdout), ThreadOutput(sys.stderr)
+
+    def run_build(extra, out=None):
+        # One build, printing to `out` (the daemon's log by default); returns
+        # its exit status
+        nonlocal state
+        with lock, stdout.routed(out), stderr.routed(out):
+            try:
+                build_args = parse_args([*argv, *extra])
+                if [path.resolve() for path in (build_args.site, build_args.csv, build_args.sources)] != paths:
+                    print("Error: this daemon builds one site; start another for other paths")
+                    return 2
+                if build_args.profile is True:
+                    build_args.profile = profile_path
+                if sha256(Path(__file__).read_bytes()) != generator_hash:
+                    print(f"Warning: {Path(__file__).name} has changed; restart the daemon to use it")
+                started = time.perf_counter()
+                build(build_args, state)
+                print(f"Built in {(time.perf_counter() - started) * 1000:.0f} ms")
+                return 0
+            except SystemExit as e:
+                if isinstance(e.code, str):
+                    print(e.code)
+                return e.code if isinstance(e.code, int) else 1
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+                # Start the next build from what's on disk, not from a half
+                # updated state
+                state = BuildState()
+                return 1
+
+    sys.stdout, sys.stderr = stdout, stderr
+    server = socketserver.ThreadingUnixStreamServer(str(daemon_socket_path), DaemonHandler)
+    server.daemon_threads = True
+    server.run_build = run_build
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    # Stopping it with kill cleans up like Ctrl-C does
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    trigger = args.trigger or trigger_path
+    print(f"Daemon building {site_dir}: run `rebuild` or touch {trigger}")
+
+    # The first build loads everything the later ones reuse
+    run_build([])
+    trigger_stamp = file_stamp(trigger)
+    try:
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            stamp = file_stamp(trigger)
+            if stamp != trigger_stamp:
+                trigger_stamp = stamp
+                if stamp is not None:
+                    print(f"Changed: {trigger}")
+                    run_build([])
+            goes_live = state.goes_live
+            if goes_live is not None and datetime.now(timezone.utc) >= goes_live:
+                print(f"Going live: posts scheduled for {w3c_time(goes_live)}")
+                run_build([])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        daemon_socket_path.unlink(missing_ok=True)
+        sys.stdout, sys.stderr = stdout.default, stderr.default
+
+
+def rebuild(argv):
+    """Ask the daemon for a build with these extra options.
+
+    Returns the build's exit status, or None if no daemon is running.
+    """
+    try:
+        client = socket.socket(socket.AF_UNIX)
+        client.connect(str(daemon_socket_path))
+    except (AttributeError, OSError):
+        return None
+    with client, client.makefile('r', encoding='utf-8') as reply:
+        client.sendall(json.dumps(argv).encode('utf-8') + b'\n')
+        for line in reply:
+            if line.startswith(DAEMON_STATUS):
+                return int(line[len(DAEMON_STATUS):])
+            sys.stdout.write(line)
+            sys.stdout.flush()
+    print("Error: the daemon closed the connection before the build finished")
+    return 1
+
+
+def load_bench():
+    # bench-posts.py has a dash in its name too, so load it by path. It runs
+    # each size in a worker process, which finds it by name in sys.modules.
+    spec = importlib.util.spec_from_file_location('bench_posts', Path(__file__).with_name('bench-posts.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def main(argv=None):
+    """Run one command, as on the command line; `argv` defaults to sys.argv.
+
+    Can be called again and again from one process: each call reads its
+    settings afresh and points the build at its own paths.
+    """
+    argv = [Word(arg) for arg in (sys.argv[1:] if argv is None else argv)]
+    if argv[:1] == ['bench']:
+        load_bench().main(argv[1:])
+        return
+    args = parse_args(argv)
+    set_paths(args.site, args.csv, args.sources)
+    # Every command but check renders pages from the site's templates
+    if args.command != 'check' and not templates_dir.is_dir():
+        raise SystemExit(f"Can't find {templates_dir}; is --site right?")
+    if args.profile is True:
+        args.profile = profile_path
+    if args.command == 'serve':
+        serve(args)
+        return
+    if args.command == 'preview':
+        build_preview(args)
+        return
+    if args.command == 'check':
+        if check_site(args.jobs if args.jobs > 0 else os.cpu_count()):
+            raise SystemExit(1)
+        return
+    if args.command == 'daemon':
+        daemon(args, argv)
+        return
+    if args.command == 'rebuild':
+        # Everything but the command goes to the daemon
+        at = next(i for i, arg in enumerate(argv) if arg is args.command)
+        status = rebuild(argv[:at] + argv[at + 1:])
+        if status is not None:
+            if status:
+                raise SystemExit(status)
+            return
+        print("No daemon is running; building here")
+    if args.cprofile is None:
+        build(args)
+        return
+
+    # Rendering in worker processes would hide it from the profiler
+    args.jobs = 1
+    profiler = cProfile.Profile()
+    profiler.runcall(build, args)
+    profiler.dump_stats(args.cprofile)
+    print(f"Saved: {args.cprofile}")
+
+
+def build(args, state=None):
+    """Build the site: post pages, index, search, feeds and sitemap.
+
+    `state` is the daemon's BuildState, carried from one build to the next.
+    """
+    phases = {}
+    started = time.perf_counter()
+
+    # Create output directory, clearing out pages an interrupted build staged
+    output_dir.mkdir(exist_ok=True)
+    for tmp_path in output_dir.glob('*.html.tmp'):
+        tmp_path.unlink()
+
+    # The templates may have been edited since an earlier build in this process
+    templates.clear()
+
+    # Every page links to the shared assets by name, so their fingerprints
+    # are part of the template
+    assets = publish_assets()
+    template_hash = sha256(json.dumps([load_template(POST_TEMPLATE).hash, assets]))
+
+    image_settings = mirror_settings(args)
+
+    if state is not None:
+        manifest = state.load_manifest(args.force, template_hash)
+    else:
+        manifest = load_manifest(args.force, template_hash)
+    old_entries = manifest.get('posts', {})
+
+    mark = time.perf_counter()
+    phases['assets'] = mark - started
+
+    # Scan all posts first to build navigation
+    scanned = state.scan_posts(old_entries) if state is not None else list(scan_posts(old_entries))
+    phases['scan'] = time.perf_counter() - mark
+
+    # A scheduled post stays off the site until its date, and the first
+    # build after that adds it like any new post: its page, its neighbours',
+    # the index and the feeds
+    posts = [post for post in scanned if post['status'] == 'published']
+    scheduled = sorted((post for post in scanned if post['status'] == 'scheduled'), key=lambda post: post['date_obj'])
+    for post in scheduled:
+        print(f"Scheduled: {post['slug']} goes live at {w3c_time(post['date_obj'])}")
+    if state is not None:
+        state.goes_live = scheduled[0]['date_obj'] if scheduled else None
+
+    mark = time.perf_counter()
+    if state is not None:
+        posts = state.sort_posts(posts)
+    else:
+        sort_posts(posts)
+    order = PostOrder(posts)
+    phases['sort'] = time.perf_counter() - mark
+
+    mark = time.perf_counter()
+
+    options = {
+        'assets': assets,
+        'images': image_settings,
+        'cleanup_stats': args.cleanup_stats,
+        'verify_cleanup': args.verify_cleanup,
+        'profile': args.profile is not None,
+        'search': args.search,
+        'minify': args.minify,
+        'cache_model': True,
+    }
+    # Render again any post whose model (or words, for search) isn't cached
+    content_cache_dir.mkdir(parents=True, exist_ok=True)
+    if any(post['markdown'] for post in posts):
+        markdown_cache_dir.mkdir(parents=True, exist_ok=True)
+    if options['search']:
+        search_cache_dir.mkdir(parents=True, exist_ok=True)
+    rendered_entries = {slug: entry for slug, entry in old_entries.items()
+                        if (content_cache_dir / f"{slug}.json").exists()
+                        and (not options['search'] or (search_cache_dir / f"{slug}.json").exists())}
+    new_entries, jobs = plan_pages(order, rendered_entries, options)
+    phases['plan'] = time.perf_counter() - mark
+
+    # Render the pages, in worker processes if asked to. Results come back in
+    # job order, so the log is the same however many workers there are.
+    workers = args.jobs if args.jobs > 0 else os.cpu_count()
+    cleanup_stats = {} if args.cleanup_stats else None
+    profiled = []
+    staged = []
+    minified = {}
+    fallbacks = 0
+    mismatches = 0
+    mark = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if workers > 1 and len(jobs) > 1:
+            executor = stack.enter_context(worker_pool(workers))
+            results = executor.map(render_page, jobs, chunksize=max(1, len(jobs) // (workers * 4)))
+        else:
+            results = map(render_page, jobs)
+
+        for job, result in zip(jobs, results):
+            if result['mismatch']:
+                print(f"Warning: single-pass cleanup differs for {job['slug']}")
+                mismatches += 1
+            fallbacks += result['fallback']
+            if result['missing_images']:
+                # Try again next build rather than keep the CDN links forever
+                new_entries[job['slug']]['images'] = 'incomplete'
+
+            if cleanup_stats is not None:
+                for name, (matches, seconds, _) in result['stats'].items():
+                    record = cleanup_stats.setdefault(name, [0, 0.0])
+                    record[0] += matches
+                    record[1] += seconds
+            if result['stages'] is not None:
+                profiled.append(post_profile(job, result))
+            if result['minified'] is not None:
+                minified[job['output_path']] = result['minified']
+            if result['staged'] is not None:
+                staged.append((result['staged'], job['output_path']))
+
+    # Pages that rendered to the bytes already on disk were never staged, so
+    # their files (and mtimes) are untouched
+    commit_outputs(staged)
+    for _, path in staged:
+        if path in minified:
+            before, after = minified[path]
+            print(f"Created: {path} (minified {before / 1024:.1f} -> {after / 1024:.1f} KiB, "
+                  f"-{(before - after) / before:.0%})")
+        else:
+            print(f"Created: {path}")
+    if minified:
+        before = sum(sizes[0] for sizes in minified.values())
+        after = sum(sizes[1] for sizes in minified.values())
+        print(f"Minified {len(minified)} pages: {before / 1024:.1f} -> {after / 1024:.1f} KiB "
+              f"(-{(before - after) / before:.0%})")
+    phases['render'] = time.perf_counter() - mark
+
+    # Remove pages for posts that were generated last time but are gone now
+    for slug in sorted(old_entries.keys() - new_entries.keys()):
+        stale_path = output_dir / f"{slug}.html"
+        if stale_path.exists():
+            stale_path.unlink()
+            print(f"Removed: {stale_path}")
+
+    # Only the site's own posts keep a cached model; this also clears out
+    # drafts an older preview cached
+    for old_path in content_cache_dir.glob('*.json'):
+        if old_path.stem not in new_entries:
+            old_path.unlink()
+
+    # Drop conversions of Markdown sources that have since changed
+    if markdown_cache_dir.exists():
+        converted = {f"{markdown_key(post['source_hash'])}.html" for post in posts if post['markdown']}
+        for old_path in markdown_cache_dir.glob('*.html'):
+            if old_path.name not in converted:
+                old_path.unlink()
+    # The search index only needs rebuilding when a post's words, or the
+    # list of posts, changed
+    mark = time.perf_counter()
+    search_hash = manifest.get('search')
+    if options['search']:
+        for slug in old_entries.keys() - new_entries.keys():
+            (search_cache_dir / f"{slug}.json").unlink(missing_ok=True)
+        search_hash = sha256(json.dumps([[post['slug'], post['title'], post['date']] for post in posts]))
+        if jobs or search_hash != manifest.get('search') or not (search_dir / "index.json").exists():
+            write_search_index(posts)
+
+    # Rebuild the writing index from the same sorted list, with the search
+    # box if there is an index for it to query
+    searchable = options['search'] and (search_dir / "index.json").exists()
+    index_hash = write_index(order, args.index_by_year, manifest.get('index'), searchable)
+
+    phases['index'] = time.perf_counter() - mark
+
+    # The sitemap and the feeds date each page by the last build that changed it
+    mark = time.perf_counter()
+    sitemap_pages = [site_dir / name for name in SITEMAP_PAGES if (site_dir / name).exists()]
+    lastmod = track_lastmod(sitemap_pages + [output_dir / f"{post['slug']}.html" for post in posts])
+    write_sitemap(lastmod)
+    feed = order.newest(args.feed_posts)
+    feeds_hash = sha256(json.dumps([args.feed_summary, [
+        [post['slug'], post['title'], post['date'], post['source_hash'], lastmod[output_dir / f"{post['slug']}.html"]]
+        for post in feed]]))
+    if feeds_hash != manifest.get('feeds') or not (feed_path.exists() and rss_path.exists()):
+        write_feeds(feed, lastmod, args.feed_summary)
+    phases['feeds'] = time.perf_counter() - mark
+
+    # Save the manifest for the next run
+    manifest = save_manifest(new_entries, template_hash, index=index_hash, search=search_hash, feeds=feeds_hash)
+    if state is not None:
+        state.save_manifest(manifest)
+
+    if args.precompress:
+        mark = time.perf_counter()
+        if brotli is None:
+            print("Warning: brotli is not installed; writing .gz copies only")
+        compressible = sorted(output_dir.glob('*.html')) + [index_path, feed_path, rss_path, sitemap_path]
+        compressible += sorted(path for path in assets_dir.iterdir() if path.suffix in ('.css', '.js'))
+        if search_dir.exists():
+            compressible += sorted(search_dir.glob('*.json'))
+        compressible += [site_dir / name for name in SHARED_SCRIPTS if (site_dir / name).exists()]
+        compressed = precompress(compressible, workers)
+        print(f"Precompressed {compressed} files ({len(compressible) - compressed} unchanged)")
+        phases['compress'] = time.perf_counter() - mark
+    if args.check:
+        mark = time.perf_counter()
+        check_site(workers)
+        phases['check'] = time.perf_counter() - mark
+    phases['total'] = time.perf_counter() - started
+
+    if cleanup_stats is not None:
+        print(f"Cleanup rules ({fallbacks} posts fell back to sequential passes):")
+        for rule in cleanup.rules:
+            matches, seconds = cleanup_stats.get(rule.name, [0, 0.0])
+            print(f"  {rule.name:<22} {matches:>6} matches {seconds * 1000:>9.2f} ms")
+    if args.verify_cleanup:
+        print(f"Cleanup verification: {mismatches} mismatches")
+    if args.profile is not None:
+        write_profile(args.profile, phases, profiled, workers, args.profile_top)
+
+    print(f"Done generating post pages! ({len(staged)} written, {len(posts) - len(staged)} unchanged)")
+
+
+if __name__ == '__main__':
+    main()
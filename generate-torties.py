@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+from pathlib import Path
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Paths
+DEFAULT_SITE = Path("/home/kav/kaiwebsite")
+
+
+def set_paths(site=DEFAULT_SITE):
+    # Every path follows the site; worker processes are given the same one
+    global site_dir, torties_dir, sized_dir, manifest_path, cache_path
+    site_dir = Path(site)
+    torties_dir = site_dir / "torties"
+    sized_dir = torties_dir / "sized"
+    manifest_path = torties_dir / "manifest.json"
+    cache_path = site_dir / ".build-cache/torties.json"
+
+
+set_paths()
+
+# Settings can also come from the site's build.json, which it shares with
+# generate-posts-v2.py; this reads the ones it has options for
+CONFIG_NAME = 'build.json'
+
+# The homepage shows a tortie in one of two columns, or full width on
+# narrow screens
+TORTIE_WIDTHS = (320, 640, 960, 1280)
+TORTIE_SIZES = '(min-width: 80ch) 35ch, 100vw'
+JPEG_SETTINGS = {'quality': 80, 'progressive': True, 'optimize': True}
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def tortie_sort_key(path):
+    # 2.jpg before 10.jpg
+    return (int(path.stem), '') if path.stem.isdigit() else (float('inf'), path.stem)
+
+
+def encode_tortie(job):
+    """Write the resized copies of one tortie. Runs in a worker process."""
+    image = ImageOps.exif_transpose(Image.open(job['source']))
+    image = image.convert('RGB')
+    width, height = image.size
+
+    variants = []
+    # Never upscale: an image narrower than a width gets a copy at its own size
+    widths = [w for w in TORTIE_WIDTHS if w < width] + ([width] if width <= TORTIE_WIDTHS[-1] else [])
+    for w in widths:
+        h = round(height * w / width)
+        name = f"{job['key']}-{w}.jpg"
+        out_path = sized_dir / name
+        if not out_path.exists():
+            resized = image.resize((w, h), Image.LANCZOS)
+            tmp_path = out_path.with_name(f"{name}.{os.getpid()}.tmp")
+            resized.save(tmp_path, format='JPEG', **JPEG_SETTINGS)
+            tmp_path.replace(out_path)
+        variants.append([name, w, h])
+    return variants
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate resized torties and the homepage's tortie manifest.")
+    parser.add_argument('--site', type=Path, default=DEFAULT_SITE, metavar='DIR',
+                        help="the site whose torties/ to resize (default: %(default)s)")
+    parser.add_argument('--config', type=Path, metavar='FILE',
+                        help=f"read settings from this JSON file (default: {CONFIG_NAME} in the site, if any)")
+    parser.add_argument('--force', action=argparse.BooleanOptionalAction, default=False,
+                        help="re-encode every tortie, ignoring the cache")
+    parser.add_argument('--jobs', '-j', type=int, default=0, metavar='N',
+                        help="encode in N worker processes (default: one per CPU)")
+    args = parser.parse_args(argv)
+
+    # Settings from the config file become the defaults, and the command
+    # line is parsed again over them
+    config_path = args.config or args.site / CONFIG_NAME
+    if args.config is not None or config_path.exists():
+        try:
+            with open(config_path, 'r') as f:
+                config = json.load(f)
+        except (OSError, ValueError) as e:
+            raise SystemExit(f"Can't read {config_path}: {e}")
+        if not isinstance(config, dict):
+            raise SystemExit(f"{config_path} should hold a JSON object of settings")
+        settings = {}
+        for key, value in config.items():
+            name = key.replace('-', '_')
+            # The rest are generate-posts-v2.py's
+            if name not in vars(args) or name == 'config':
+                continue
+            if name == 'site' and isinstance(value, str):
+                value = str(config_path.parent / Path(value).expanduser())
+            settings[name] = value
+        parser.set_defaults(**settings)
+        args = parser.parse_args(argv)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    set_paths(args.site)
+
+    if Image is None:
+        raise SystemExit("Pillow is required to resize torties (pip install Pillow)")
+
+    cache = {}
+    if cache_path.exists() and not args.force:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+
+    # Hash each source, trusting the cached hash if the file is untouched.
+    # Derivatives are named after the hash, so a tortie is only re-encoded
+    # when its content changes.
+    sources = sorted(torties_dir.glob('*.jpg'), key=tortie_sort_key)
+    entries = {}
+    jobs = []
+    for source in sources:
+        stat = source.stat()
+        source_stat = [stat.st_mtime_ns, stat.st_size]
+        entry = cache.get(source.name, {})
+        if entry.get('stat') != source_stat:
+            entry = {'stat': source_stat, 'key': sha256_file(source)[:16]}
+        entries[source.name] = entry
+        if not entry.get('variants') or not all((sized_dir / name).exists() for name, _, _ in entry['variants']):
+            jobs.append({'name': source.name, 'source': source, 'key': entry['key']})
+
+    sized_dir.mkdir(exist_ok=True)
+    workers = args.jobs if args.jobs > 0 else os.cpu_count()
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=set_paths, initargs=(site_dir,)) as executor:
+            results = list(executor.map(encode_tortie, jobs))
+    else:
+        results = list(map(encode_tortie, jobs))
+    for job, variants in zip(jobs, results):
+        entries[job['name']]['variants'] = variants
+        print(f"Created: {', '.join(name for name, _, _ in variants)} from {job['source']}")
+
+    # Remove derivatives of torties that changed or are gone
+    current = {name for entry in entries.values() for name, _, _ in entry['variants']}
+    for old_path in sized_dir.glob('*.jpg'):
+        if old_path.name not in current:
+            old_path.unlink()
+            print(f"Removed: {old_path}")
+
+    # The homepage picks from this list, so it always matches what's on disk
+    manifest = {'sizes': TORTIE_SIZES, 'torties': []}
+    for source in sources:
+        variants = entries[source.name]['variants']
+        name, width, height = variants[min(1, len(variants) - 1)]
+        manifest['torties'].append({
+            'src': f"torties/sized/{name}",
+            'srcset': ', '.join(f"torties/sized/{n} {w}w" for n, w, _ in variants),
+            'width': width,
+            'height': height,
+        })
+    manifest_json = json.dumps(manifest, indent=1) + '\n'
+    if not manifest_path.exists() or manifest_path.read_text() != manifest_json:
+        manifest_path.write_text(manifest_json)
+        print(f"Created: {manifest_path}")
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(cache_path, 'w') as f:
+        json.dump(entries, f, indent=1, sort_keys=True)
+
+    print(f"Done generating torties! ({len(jobs)} encoded, {len(sources) - len(jobs)} unchanged)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+// Search over the index generate-posts-v2.py writes to search/.
+// Everything runs in the browser: index.json lists the posts and the term
+// shards, and a query only downloads the shards holding its words.
+(function() {
+  // Must match SEARCH_SHARDS and search_shard() in generate-posts-v2.py
+  function shardOf(term, count) {
+    let h = 0x811c9dc5;
+    for (const ch of term) {
+      h ^= ch.codePointAt(0);
+      h = Math.imul(h, 0x01000193) >>> 0;
+    }
+    return h % count;
+  }
+
+  // Same words as the generator's \w+ over lowercased text
+  function tokenize(text) {
+    return text.toLowerCase().match(/[\p{L}\p{N}_]+/gu) || [];
+  }
+
+  // A posting list is flat: per post, the gap from the previous post's
+  // number, the count of positions, then the gaps between positions
+  function decode(list) {
+    const postings = new Map();
+    let doc = 0;
+    let i = 0;
+    while (i < list.length) {
+      doc += list[i++];
+      const positions = new Array(list[i++]);
+      let position = 0;
+      for (let k = 0; k < positions.length; k++) {
+        position += list[i++];
+        positions[k] = position;
+      }
+      postings.set(doc, positions);
+    }
+    return postings;
+  }
+
+  // Quoted phrases must match in order; other words can be anywhere
+  function parseQuery(text) {
+    const groups = [];
+    for (const m of text.matchAll(/"([^"]*)"?|[^"]+/g)) {
+      const words = tokenize(m[1] !== undefined ? m[1] : m[0]);
+      if (m[1] !== undefined) {
+        if (words.length) groups.push(words);
+      } else {
+        for (const word of words) groups.push([word]);
+      }
+    }
+    return groups;
+  }
+
+  // How many times a phrase appears in one post: walk the sorted positions
+  // of each word in turn, keeping the starts the next word lines up with
+  function phraseMatches(postingsByWord, doc, words) {
+    let starts = postingsByWord.get(words[0]).get(doc);
+    for (let i = 1; i < words.length && starts.length; i++) {
+      const positions = postingsByWord.get(words[i]).get(doc);
+      const next = [];
+      let k = 0;
+      for (const start of starts) {
+        while (k < positions.length && positions[k] < start + i) k++;
+        if (positions[k] === start + i) next.push(start);
+      }
+      starts = next;
+    }
+    return starts.length;
+  }
+
+  function createSearch(fetchJson) {
+    const shards = new Map();
+    const terms = new Map();
+    const titles = new Map();
+    let index = null;
+
+    function loadIndex() {
+      if (!index) index = fetchJson('index.json');
+      return index;
+    }
+
+    async function postings(word) {
+      if (terms.has(word)) return terms.get(word);
+      const { shards: names } = await loadIndex();
+      const name = names[shardOf(word, names.length)];
+      if (!shards.has(name)) shards.set(name, fetchJson(name));
+      const list = (await shards.get(name))[word];
+      const decoded = list ? decode(list) : new Map();
+      terms.set(word, decoded);
+      return decoded;
+    }
+
+    async function query(text) {
+      const groups = parseQuery(text);
+      if (!groups.length) return [];
+      const { docs } = await loadIndex();
+      const words = [...new Set(groups.flat())];
+      const postingsByWord = new Map(await Promise.all(words.map(async word => [word, await postings(word)])));
+
+      // Posts holding every word, starting from the rarest
+      let candidates = null;
+      for (const word of [...words].sort((a, b) => postingsByWord.get(a).size - postingsByWord.get(b).size)) {
+        const holding = postingsByWord.get(word);
+        candidates = candidates ? candidates.filter(doc => holding.has(doc)) : [...holding.keys()];
+        if (!candidates.length) return [];
+      }
+
+      const results = [];
+      for (const doc of candidates) {
+        let score = 0;
+        for (const group of groups) {
+          const matches = phraseMatches(postingsByWord, doc, group);
+          if (!matches) {
+            score = 0;
+            break;
+          }
+          score += matches;
+        }
+        if (!score) continue;
+        const [slug, title, date] = docs[doc];
+        // Words in the title count for more than words in the body
+        if (!titles.has(doc)) titles.set(doc, new Set(tokenize(title)));
+        score += 10 * words.filter(word => titles.get(doc).has(word)).length;
+        results.push({ doc, slug, title, date, score });
+      }
+      // Best first; ties newest first (posts are numbered oldest first)
+      return results.sort((a, b) => b.score - a.score || b.doc - a.doc);
+    }
+
+    return { query };
+  }
+
+  globalThis.postSearch = { createSearch, tokenize, shardOf };
+
+  // Hook up the search box on writing.html, if this is it
+  if (typeof document === 'undefined') return;
+  const input = document.getElementById('search');
+  const list = document.getElementById('search-results');
+  const postIndex = document.getElementById('post-index');
+  if (!input || !list) return;
+
+  const search = createSearch(name => fetch('search/' + name).then(response => response.json()));
+  let latest = 0;
+
+  input.addEventListener('input', async () => {
+    const text = input.value.trim();
+    const run = ++latest;
+    if (!text) {
+      list.hidden = true;
+      if (postIndex) postIndex.hidden = false;
+      return;
+    }
+    const results = await search.query(text);
+    // A newer query has been typed since
+    if (run !== latest) return;
+
+    list.replaceChildren(...results.map(result => {
+      const item = document.createElement('li');
+      const link = document.createElement('a');
+      link.href = 'posts/' + result.slug + '.html';
+      link.textContent = result.title.charAt(0).toUpperCase() + result.title.slice(1);
+      item.append(link);
+      if (result.date) {
+        const date = document.createElement('span');
+        date.className = 'post-date';
+        date.textContent = new Date(result.date).toLocaleString('en-US', { month: 'long', year: 'numeric', timeZone: 'UTC' });
+        item.append(' ', date);
+      }
+      return item;
+    }));
+    if (!results.length) {
+      const item = document.createElement('li');
+      item.textContent = 'No posts found';
+      list.append(item);
+    }
+    list.hidden = false;
+    if (postIndex) postIndex.hidden = true;
+  });
+})();
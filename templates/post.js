@@ -0,0 +1,44 @@
+const themeToggle = document.getElementById('theme-toggle');
+const root = document.documentElement;
+
+function initTheme() {
+  const savedTheme = localStorage.getItem('theme') || 'dark';
+  if (savedTheme === 'light') {
+    themeToggle.textContent = '☽';
+    window.starfield.stop();
+    window.lightStarfield.start();
+  } else {
+    themeToggle.textContent = '☀';
+    window.lightStarfield.stop();
+    window.starfield.start();
+  }
+}
+
+function setTheme(theme) {
+  if (theme === 'light') {
+    root.setAttribute('data-theme', 'light');
+    themeToggle.textContent = '☽';
+    window.starfield.stop();
+    window.lightStarfield.start();
+  } else {
+    root.removeAttribute('data-theme');
+    themeToggle.textContent = '☀';
+    window.lightStarfield.stop();
+    window.starfield.start();
+  }
+  localStorage.setItem('theme', theme);
+}
+
+function toggleTheme() {
+  const current = root.getAttribute('data-theme') === 'light' ? 'light' : 'dark';
+  setTheme(current === 'dark' ? 'light' : 'dark');
+}
+
+themeToggle.addEventListener('click', toggleTheme);
+initTheme();
+
+document.getElementById('home-btn').addEventListener('click', () => window.location.href = '../index.html');
+document.getElementById('writing-btn').addEventListener('click', () => window.location.href = '../writing.html');
+document.getElementById('gallery-btn').addEventListener('click', () => window.location.href = '../gallery.html');
+document.getElementById('collection-btn').addEventListener('click', () => window.location.href = '../collection.html');
+document.getElementById('return-to-top').addEventListener('click', () => window.scrollTo({ top: 0, behavior: 'smooth' }));
@@ -0,0 +1,14 @@
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+
+@pytest.fixture(scope='session')
+def gen():
+    # generate-posts-v2.py can't be imported by name
+    path = Path(__file__).resolve().parent.parent / "generate-posts-v2.py"
+    spec = importlib.util.spec_from_file_location('generate_posts_v2', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
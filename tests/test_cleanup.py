@@ -0,0 +1,33 @@
+import pytest
+
+# Inputs where the order of the whole-document passes matters
+CASCADES = [
+    # Removing the link completes the open-image button around it
+    ('<button><a href="/subscribe?"></a>Open image </button>', ''),
+    # Removing the button first leaves the image link without one
+    ('<a class="image-link"><button>Open image </button></button></a>', '<a class="image-link"></button></a>'),
+    # A rule matching inside another's body leaves it as it was
+    ('<div class="subscription-widget"><p>Thanks for reading!</p></div>after', 'after'),
+    # Once the preformatted close is rewritten, the subscription div runs
+    # past the button's close before the button is removed
+    ('<iframe src="https://open.spotify.com/x"><button class="subscribe"><div class="subscription">'
+     '<pre>x</pre></div></button></iframe></div>',
+     '<iframe src="https://open.spotify.com/x"><button class="subscribe">'),
+    # Removing the second iframe gives the image link its button's close,
+    # inside the image-button div that was already matched
+    ('<iframe src="https://open.spotify.com/x"></iframe><div class="image-button"><a class="image-link">'
+     '<button></div></div></button><iframe src="https://open.spotify.com/x">x</iframe></a></div>',
+     ''),
+]
+
+
+def sequential(gen, text):
+    for rule in gen.CLEANUP_RULES:
+        text = rule.regex.sub(rule.replacement, text)
+    return text
+
+
+@pytest.mark.parametrize('text, expected', CASCADES)
+def test_single_pass_matches_sequential(gen, text, expected):
+    assert sequential(gen, text) == expected
+    assert gen.CleanupEngine(gen.CLEANUP_RULES).clean(text) == expected
@@ -0,0 +1,8 @@
+def test_hard_breaks(gen):
+    # Every line ending in two spaces breaks, the first one included
+    html = gen.convert_markdown("Roses are red  \nviolets are blue  \nsugar is sweet")
+    assert html == "<p>Roses are red<br>\nviolets are blue<br>\nsugar is sweet</p>"
+
+
+def test_trailing_spaces_at_paragraph_end(gen):
+    assert gen.convert_markdown("one line  ") == "<p>one line</p>"
@@ -0,0 +1,16 @@
+def test_empty_paragraph_kept(gen):
+    # An empty <p> is a blank line in the post
+    html = gen.minify_content("<p>a</p><p></p><p>b</p>")
+    assert html == "<p>a</p><p></p><p>b</p>"
+
+
+def test_bare_wrappers_dropped(gen):
+    # Emptying the <span> leaves its <div> bare and empty too; a classed one stays
+    html = gen.minify_content('<div data-x="1"><span> </span></div><div class="fake-input"></div>')
+    assert html == '<div class="fake-input"></div>'
+
+
+def test_quoted_greater_than(gen):
+    # A > inside a quoted value doesn't end the tag
+    html = gen.minify_content('<a title="a > b" data-x="c>d" href="/x">link</a>')
+    assert html == '<a title="a > b" href="/x">link</a>'